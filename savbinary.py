@@ -22,8 +22,36 @@
 # Python package to create XML rendition of Quantum data from the binaries
 
 import exceptions
+import sys
 import struct
 import datetime
+import mmap
+import itertools
+import collections
+import zlib
+import marshal
+import tempfile
+import os
+import math
+import hashlib
+import cPickle
+import threading
+import Queue
+import gzip
+import bz2
+import zipfile
+import fnmatch
+from multiprocessing.pool import ThreadPool
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+try:
+	from backports import lzma
+except ImportError:
+	lzma = None
 
 def forceEncoding (text, encoding='ascii'):
 	if type (text) != unicode:
@@ -39,26 +67,29 @@ def forceEncoding (text, encoding='ascii'):
 				lchars.append("&#%d;" % ord(char))				
 		return ''.join(lchars)
 
-def setBig():
-	global big, wordFormat, longFormat, signedLongFormat, floatFormat, endianity, endianityChar
-	wordFormat = '>H'
-	longFormat = '>L'
-	signedLongFormat = '>l'
-	floatFormat = '>d'
-	big = True
-	endianity = "big"
-	endianityChar = '>'
-
-def setLittle():
-	global big, wordFormat, longFormat, signedLongFormat, floatFormat, endianity, endianityChar
-	wordFormat = '<H'
-	longFormat = '<L'
-	signedLongFormat = '<l'
-	floatFormat = '<d'
-	big = False
-	endianity = "little"
-	endianityChar = '<'
-setLittle ()
+# Byte order is a property of each file: every dataset holds one of the two
+# ByteOrder objects, whose precompiled structs are shared and never change,
+# so datasets of either byte order can be read side by side in any thread
+
+class ByteOrder:
+	def __init__ (self, char, name):
+		self.char = char
+		self.name = name
+		self.word = struct.Struct (char + 'H')
+		self.long = struct.Struct (char + 'L')
+		self.signedLong = struct.Struct (char + 'l')
+		self.double = struct.Struct (char + 'd')
+		self.zlibHeader = struct.Struct (char + 'qqq')
+		self.zlibBlock = struct.Struct (char + 'qqLL')
+		
+bigEndian = ByteOrder ('>', "big")
+littleEndian = ByteOrder ('<', "little")
+
+def detectByteOrder (data):
+	for byteOrder in (bigEndian, littleEndian):
+		if byteOrder.long.unpack_from (data, 64) [0] in (2, 3):
+			return byteOrder
+	raise SAVError, "Can't determine layout code and endianity"
 
 def adjustedValue (v):
 	vOver11 = v/11.0
@@ -70,6 +101,15 @@ def adjustedValue (v):
 
 SPSSEpochalDelta = datetime.datetime.utcfromtimestamp (0.0) - datetime.datetime (1582, 10, 14)
 SPSSEpochalDeltaSeconds = SPSSEpochalDelta.days*24*3600
+defaultSysmis = -sys.float_info.max
+caseIndexInterval = 256
+defaultDistributionCap = 10000
+defaultCacheSize = 256 << 20
+cacheVersion = 4
+dateMemoSize = 1 << 16
+textCacheSize = 4096
+caseIndexVersion = 1
+sampleBlockSize = 64
 
 def hexInterpretation (data):
 	count = len(data)
@@ -78,11 +118,6 @@ def hexInterpretation (data):
 	# to interpret as floating point at e.g.
 	# http://babbage.cs.qc.edu/IEEE-754/IEEE-754hex64.html
 	
-def unpackFloat (data):
-	value = struct.unpack(floatFormat, data) [0]
-	#print value, hexInterpretation (data)
-	return value
-
 floatFormatCode = 5
 dateFormatCode = 20
 timeFormatCode = 21
@@ -143,6 +178,496 @@ def requireByes (data, offset, length):
 			(length, offset)
 	#return data [offset:offset+length]
 			
+# Map the file read-only rather than reading it into memory; slices and
+# struct.unpack_from read straight from the mapping, so resident memory does
+# not grow with the size of the data section. Python 2 mmap objects don't
+# support memoryview, but they do support the buffer interface used by
+# unpack_from and slicing. Empty files can't be mapped, so fall back to read.
+
+def openBinData (filename, memoryMap=True):
+	binFile = open (filename, 'rb')
+	try:
+		if memoryMap:
+			try:
+				return mmap.mmap (binFile.fileno (), 0, access=mmap.ACCESS_READ)
+			except (mmap.error, ValueError), e:
+				pass
+		return binFile.read ()
+	finally:
+		binFile.close ()
+		
+# SAV data read from a pipe or other non-seekable file-like object. The
+# dictionary is read record by record, just far enough to find where the
+# data section starts; the data section is then read on a background thread
+# into a bounded queue of chunks, so decoding starts while bytes are still
+# arriving and only readAhead chunks are ever held. It can be read once,
+# unless an opener is given to open the stream afresh for each later pass.
+
+streamReadAhead = 8
+
+class StreamSource:
+	def __init__ (self, stream, name=None, readAhead=streamReadAhead, closeStream=False,
+		opener=None):
+		self.stream = stream
+		self.name = name or getattr (stream, "name", "<stream>")
+		self.readAhead = readAhead
+		self.closeStream = closeStream
+		self.opener = opener
+		self.head = ""
+		self.consumed = False
+		self.reader = None
+		self.stopped = threading.Event ()
+		
+	def reopen (self):
+		self.stopped.set ()
+		if self.reader is not None:
+			self.reader.join ()
+		if self.closeStream:
+			self.stream.close ()
+		self.stream = self.opener ()
+		self.closeStream = True
+		self.head = ""
+		self.stopped = threading.Event ()
+		
+	def readHead (self, size):
+		pieces = [self.head]
+		headSize = len (self.head)
+		while headSize < size:
+			data = self.stream.read (max (size - headSize, 1 << 16))
+			if not data:
+				raise SAVError, "Unexpected end of stream, looking for %d bytes at offset %d" %\
+					(size - headSize, headSize)
+			pieces.append (data)
+			headSize += len (data)
+		self.head = "".join (pieces)
+		return self.head
+		
+	def readDictionary (self):
+		byteOrder = detectByteOrder (self.readHead (176))
+		long = byteOrder.long
+		offset = 176
+		while True:
+			recordType = long.unpack_from (self.readHead (offset + 4), offset) [0]
+			offset += 4
+			if recordType == 2:
+				head = self.readHead (offset + 28)
+				hasLabel = long.unpack_from (head, offset + 4) [0]
+				missingCount = abs (byteOrder.signedLong.unpack_from (head, offset + 8) [0])
+				offset += 28
+				if hasLabel:
+					labelLength = long.unpack_from (self.readHead (offset + 4), offset) [0]
+					offset += 4 + (labelLength + 3) / 4 * 4
+				offset += 8 * missingCount
+			elif recordType == 3:
+				labelCount = long.unpack_from (self.readHead (offset + 4), offset) [0]
+				offset += 4
+				for index in xrange (labelCount):
+					labelLength = ord (self.readHead (offset + 9) [offset + 8])
+					offset += 8 + (labelLength + 1 + 7) / 8 * 8
+			elif recordType in (4, 6):
+				count = long.unpack_from (self.readHead (offset + 4), offset) [0]
+				offset += 4 + count * (4, 80) [recordType == 6]
+			elif recordType == 7:
+				head = self.readHead (offset + 12)
+				size = long.unpack_from (head, offset + 4) [0]
+				count = long.unpack_from (head, offset + 8) [0]
+				offset += 12 + size * count
+			elif recordType == 999:
+				offset += 4
+				break
+			else:
+				raise SAVError, "Unknown record type %d at offset %d (X%x)" %\
+					(recordType, offset - 4, offset - 4)
+		return self.readHead (offset)
+		
+	def _readChunks (self, chunks, dataOffset, dataEnd):
+		def put (item):
+			while not self.stopped.is_set ():
+				try:
+					chunks.put (item, timeout=0.1)
+					return True
+				except Queue.Full:
+					pass
+			return False
+		try:
+			position = len (self.head)
+			chunk = self.head [dataOffset:dataEnd]
+			self.head = self.head [:dataOffset]
+			while True:
+				if chunk and not put (chunk): return
+				if dataEnd is not None and position >= dataEnd: break
+				data = self.stream.read (bytecodeChunkSize)
+				if not data:
+					if dataEnd is not None:
+						raise SAVError, "Unexpected end of stream at offset %d, data runs to offset %d" %\
+							(position, dataEnd)
+					break
+				if dataEnd is not None:
+					chunk = data [max (dataOffset - position, 0): dataEnd - position]
+				else:
+					chunk = data [max (dataOffset - position, 0):]
+				position += len (data)
+			put (None)
+		except exceptions.Exception, e:
+			put (e)
+			
+	# Yields (chunk, final) pairs for the bytes from dataOffset up to dataEnd
+	# (or the end of the stream), holding one chunk back to tell the last
+	
+	def getChunks (self, dataOffset, dataEnd=None):
+		if self.consumed:
+			if self.opener is None:
+				raise SAVError, "Data from %s has already been read and can't be read again" % self.name
+			self.reopen ()
+		self.consumed = True
+		chunks = Queue.Queue (self.readAhead)
+		reader = threading.Thread (target=self._readChunks, args=(chunks, dataOffset, dataEnd))
+		reader.daemon = True
+		reader.start ()
+		self.reader = reader
+		try:
+			previous = None
+			while True:
+				chunk = chunks.get ()
+				if isinstance (chunk, exceptions.Exception):
+					raise chunk
+				if chunk is None: break
+				if previous is not None:
+					yield previous, False
+				previous = chunk
+			yield previous or "", True
+		finally:
+			self.stopped.set ()
+			
+	# ZSAV data is a series of complete zlib streams, inflated in turn here
+	# since the trailer indexing them follows the data
+	
+	def getInflatedChunks (self, dataOffset, dataEnd):
+		inflater = zlib.decompressobj ()
+		for data, final in self.getChunks (dataOffset, dataEnd):
+			inflated = []
+			while data:
+				inflated.append (inflater.decompress (data))
+				data = inflater.unused_data
+				if data:
+					inflater = zlib.decompressobj ()
+			yield "".join (inflated), final
+			
+	def close (self):
+		self.stopped.set ()
+		if self.closeStream:
+			self.stream.close ()
+		
+# SAV files kept gzip, bzip2, xz or zip compressed are read through the
+# matching decompressor as streams, so that decompression runs on the
+# stream's reader thread and nothing is written to disk; each pass over the
+# data decompresses the file again. Wrappers are
+# recognised by their signatures; xz needs the backports.lzma module, as
+# Python 2 has no lzma of its own. A zip archive must hold one .sav file.
+
+wrapperExtensions = (".gz", ".bz2", ".xz", ".zip")
+
+def openWrappedFile (filename):
+	signatureFile = open (filename, 'rb')
+	try:
+		signature = signatureFile.read (6)
+	finally:
+		signatureFile.close ()
+	if signature.startswith ("\x1f\x8b"):
+		return gzip.GzipFile (filename, 'rb')
+	elif signature.startswith ("BZh"):
+		return bz2.BZ2File (filename, 'rb')
+	elif signature == "\xfd7zXZ\0":
+		if lzma is None:
+			raise SAVError, "%s is xz compressed; reading it needs the backports.lzma module" % filename
+		return lzma.LZMAFile (filename, 'rb')
+	elif signature.startswith ("PK\x03\x04"):
+		archive = zipfile.ZipFile (filename)
+		try:
+			members = [member for member in archive.namelist ()
+				if os.path.splitext (member) [1].lower () in (".sav", ".zsav")]
+			if len (members) != 1:
+				raise SAVError, "Zip archive %s holds %d .sav file(s), not one" %\
+					(filename, len (members))
+			return archive.open (members [0])
+		finally:
+			archive.close ()
+	return None
+	
+# Bytecode decompression in bulk. The only sequential dependency between
+# control blocks is where the next one starts (after 8 opcodes plus one raw
+# value per 253 opcode), so blocks are located with a single string count
+# each and everything else is expanded with array operations.
+
+bytecodeChunkSize = 1 << 20
+blankItem = "        "
+
+def decodeBytecode (data, bias, floatDtype, final=True):
+	"""Decode the whole control blocks at the start of the string data.
+	
+	Returns (codes, values, slots, consumed). codes holds the opcode of each
+	data item, with padding (0) and end-of-file (252) opcodes removed.
+	values holds each item as float64: code - bias for 1-251, the raw value
+	for 253, the raw value of eight blanks for 254 and NaN for 255 (system
+	missing). slots holds the offset in data of each 253 item's raw 8 bytes
+	and -1 for other items. consumed is the number of bytes of data decoded;
+	a block whose raw values run past the end of data is left for the next
+	call unless final is set."""
+	blockOffsets = []
+	position = 0
+	size = len (data)
+	while position + 8 <= size:
+		blockEnd = position + 8 + 8 * data.count ('\xfd', position, position + 8)
+		if blockEnd > size and not final: break
+		blockOffsets.append (position)
+		position = blockEnd
+	if position > size:
+		data += blankItem [:1] * (position - size)	# truncated final block
+	consumed = min (position, size)
+	if not blockOffsets:
+		return (numpy.zeros (0, numpy.uint8), numpy.zeros (0, numpy.float64),
+			numpy.zeros (0, numpy.int64), consumed)
+	byteArray = numpy.frombuffer (data, numpy.uint8)
+	starts = numpy.array (blockOffsets, numpy.int64)
+	opcodes = byteArray [starts [:, None] + numpy.arange (8)]
+	isRaw = opcodes == 253
+	rawSlots = starts [:, None] + 8 * numpy.cumsum (isRaw, axis=1)
+	keep = (opcodes != 0) & (opcodes != 252)
+	codes = opcodes [keep]
+	slots = numpy.where (isRaw, rawSlots, -1) [keep]
+	values = codes.astype (numpy.float64) - bias
+	raw = codes == 253
+	if raw.any ():
+		rawValues = numpy.frombuffer (data, floatDtype, len (data) / 8)
+		values [raw] = rawValues [slots [raw] / 8]
+	values [codes == 254] = numpy.frombuffer (blankItem, floatDtype) [0]
+	values [codes == 255] = numpy.nan
+	return codes, values, slots, consumed
+
+def inflateBlock (binData, zlibBlock):
+	uncompressedOffset, compressedOffset, uncompressedSize, compressedSize = zlibBlock
+	requireByes (binData, compressedOffset, compressedSize)
+	chunk = zlib.decompress (binData [compressedOffset: compressedOffset + compressedSize])
+	if len (chunk) != uncompressedSize:
+		raise SAVError, "ZLIB block at offset %d inflated to %d byte(s), expected %d" %\
+			(compressedOffset, len (chunk), uncompressedSize)
+	return chunk
+	
+# A decode plan turns the variables into one specialised handler per
+# variable, compiled once per dataset and error treatment, so that the case
+# loop only dispatches rather than re-examining each variable's type, format,
+# label list and missing values for every value.
+#
+# decoders [i] (dataItem, nextItem, case) decodes variable i from the item
+# stream, calling nextItem for any further segments of a string.
+# For numeric variables codedCheckers [i] (value, case) handles a value stored
+# as a compression code (or None for system missing) and rawConverters [i]
+# (value, case) a value stored as a raw float; both are None for strings.
+# kinds [i] names the handler chosen for variable i.
+
+# Dates, times and datetimes are seconds since 14 Oct 1582. A file usually
+# holds few distinct dates (interview dates, say) many times over, so their
+# ISO text is memoised, the memo being cleared whenever it reaches memoSize.
+# decodeArray converts a whole column to datetime64 (timedelta64 for times)
+# without going through datetime; unlike the text it isn't shifted to local
+# time. It also returns a mask of the values that can't be converted.
+
+class DateDecoder:
+	def __init__ (self, kind, memoSize=dateMemoSize):
+		self.kind = kind
+		self.start, self.end = {"date": (0, 10), "time": (11, 19), "datetime": (0, None)} [kind]
+		self.memoSize = memoSize
+		self.memo = {}
+		
+	def decode (self, value):
+		text = self.memo.get (value)
+		if text is None:
+			text = datetime.datetime.fromtimestamp\
+				(value - SPSSEpochalDeltaSeconds).isoformat () [self.start: self.end]
+			if len (self.memo) >= self.memoSize:
+				self.memo.clear ()
+			self.memo [value] = text
+		return text
+		
+	def decodeArray (self, values):
+		with numpy.errstate (invalid="ignore"):
+			invalid = ~(numpy.abs (values) <= 1e15)
+		seconds = numpy.where (invalid, 0, values)
+		if self.kind == "time":
+			seconds = numpy.mod (seconds, 24 * 3600)
+			return seconds.astype (numpy.int64).astype ("timedelta64[s]"), invalid
+		return (seconds - SPSSEpochalDeltaSeconds).astype (numpy.int64).astype ("datetime64[s]"), invalid
+		
+class DecodePlan:
+	def __init__ (self, dataset, errorTreatment):
+		self.dataset = dataset
+		self.errorTreatment = errorTreatment
+		self.dateDecoders = {}
+		self.kinds = []
+		self.decoders = []
+		self.codedCheckers = []
+		self.rawConverters = []
+		self.itemCounts = []
+		self.missingArrayTests = []
+		self.skippers = []
+		unpack = dataset.byteOrder.double.unpack
+		for variable in dataset.variables:
+			if variable.type_ == 0:
+				kind, checkCoded = self._compileCodedChecker (variable)
+				kind, convertRaw = self._compileRawConverter (variable, kind)
+				decoder = self._compileNumericDecoder (checkCoded, convertRaw, unpack)
+			else:
+				extensionCount = (variable.stringLength + 7) / 8 - 1
+				kind = "string%d" % (extensionCount + 1)
+				checkCoded = convertRaw = None
+				decoder = self._compileStringDecoder (extensionCount)
+			self.kinds.append (kind)
+			self.itemCounts.append (variable.type_ == 0 and 1 or (variable.stringLength + 7) / 8)
+			self.skippers.append (self._compileSkipper (self.itemCounts [-1] - 1))
+			if variable.isExcluded:
+				decoder = self.skippers [-1]
+			if numpy is not None and variable.type_ == 0:
+				self.missingArrayTests.append (compileMissingArrayTest (variable))
+			else:
+				self.missingArrayTests.append (None)
+			self.decoders.append (decoder)
+			self.codedCheckers.append (checkCoded)
+			self.rawConverters.append (convertRaw)
+			
+	def _compileCodedChecker (self, variable):
+		isMissing = compileMissingTest (variable)
+		if variable.labelList is not None:
+			dataset = self.dataset
+			errorTreatment = self.errorTreatment
+			def checkLabelled (value, case):
+				if value is None: return None
+				if isMissing is not None and isMissing (value): return None
+				if value < 0:
+					return dataset._checkCodedValue (variable, value, case, errorTreatment)
+				return value
+			if isMissing is None:
+				return "labelled", checkLabelled
+			return "labelled/missing", checkLabelled
+		if isMissing is not None:
+			def checkMissing (value, case):
+				if value is not None and isMissing (value): return None
+				return value
+			return "numeric/missing", checkMissing
+		def checkNone (value, case):
+			return value
+		return "numeric", checkNone
+		
+	def getDateDecoder (self, kind):
+		if not self.dateDecoders.has_key (kind):
+			self.dateDecoders [kind] = DateDecoder (kind)
+		return self.dateDecoders [kind]
+		
+	def _compileRawConverter (self, variable, kind):
+		formatType = variable.write_.format_type
+		if formatType == dateFormatCode:
+			kind = "date"
+		elif formatType == timeFormatCode:
+			kind = "time"
+		elif formatType == datetimeFormatCode:
+			kind = "datetime"
+		else:
+			def convertNone (value, case):
+				return value
+			return kind, convertNone
+		decode = self.getDateDecoder (kind).decode
+		dataset = self.dataset
+		errorTreatment = self.errorTreatment
+		def convertTime (value, case):
+			try:
+				return decode (value)
+			except exceptions.Exception, e:
+				return dataset._convertRawValue (variable, value, case, errorTreatment)
+		return kind, convertTime
+		
+	def _compileNumericDecoder (self, checkCoded, convertRaw, unpack):
+		def decodeNumeric (dataItem, nextItem, case):
+			if dataItem.__class__ is str:
+				return convertRaw (unpack (dataItem) [0], case)
+			return checkCoded (dataItem, case)
+		return decodeNumeric
+		
+	def _compileStringDecoder (self, extensionCount):
+		if extensionCount == 0:
+			def decodeString (dataItem, nextItem, case):
+				return dataItem
+		else:
+			extensions = xrange (extensionCount)
+			def decodeString (dataItem, nextItem, case):
+				return dataItem + "".join ([nextItem () for blockIndex in extensions])
+		return decodeString
+		
+	# Variables left out of the selection, and cases left out of the case
+	# selection: their items are passed over
+	
+	def _compileSkipper (self, extensionCount):
+		if extensionCount == 0:
+			def skip (dataItem, nextItem, case):
+				return None
+		else:
+			extensions = xrange (extensionCount)
+			def skip (dataItem, nextItem, case):
+				for blockIndex in extensions:
+					nextItem ()
+				return None
+		return skip
+		
+def compileMissingArrayTest (variable):
+	if variable.n_missing_values == 0:
+		return None
+	if variable.n_missing_values > 0:
+		missingValues = numpy.array (variable.missing_values, numpy.float64)
+		return lambda values: numpy.in1d (values, missingValues)
+	if variable.n_missing_values == -2:
+		low, high = variable.missing_values [:2]
+		return lambda values: (values >= low) & (values <= high)
+	if variable.n_missing_values == -3:
+		low, high, discrete = variable.missing_values [:3]
+		return lambda values: ((values >= low) & (values <= high)) | (values == discrete)
+	return lambda values: numpy.array ([bool (variable.isValidMissingValue (value))
+		for value in values.tolist ()], numpy.bool_)
+		
+# Columns of a CaseBatch. values is a float64 array for numeric variables and
+# an int64 array for labelled ones (float64 if any value isn't integral), with
+# mask True where the value is missing; a list of values (None if missing)
+# for dates and times, or with datetimes a datetime64 (timedelta64 for times)
+# array and mask; and a fixed-width byte string array for strings.
+
+class CaseColumn:
+	def __init__ (self, variable, kind, values, mask=None):
+		self.variable = variable
+		self.kind = kind
+		self.values = values
+		self.mask = mask
+		
+class CaseBatch:
+	def __init__ (self, start, size, positions, columns):
+		self.start = start
+		self.size = size
+		self.positions = positions
+		self.columns = columns
+		
+	def column (self, position):
+		return self.columns [position]
+		
+def compileMissingTest (variable):
+	if variable.n_missing_values == 0:
+		return None
+	if variable.n_missing_values > 0:
+		missingValues = frozenset (variable.missing_values)
+		return lambda value: value in missingValues
+	if variable.n_missing_values == -2:
+		low, high = variable.missing_values [:2]
+		return lambda value: low <= value <= high
+	if variable.n_missing_values == -3:
+		low, high, discrete = variable.missing_values [:3]
+		return lambda value: low <= value <= high or value == discrete
+	return variable.isValidMissingValue
+	
 class SPSSOutputFormat:
 	def __init__ (self, bytes):
 		self.dp = bytes [0]
@@ -158,21 +683,142 @@ class SPSSOutputFormat:
 		# format_type_code = formatCodeMap [self.format_type]
 		return "Format #%s %s.%s" % (self.format_type_code, self.width, self.dp)
 
+# Large files often repeat the same value labels (a rating scale, say) in
+# many label records. Each list's fingerprint is the index of the first list
+# with identical content, set when the dictionary is parsed; lists with the
+# same fingerprint share one labels dict, and comparing fingerprints is
+# enough to tell whether two lists are the same.
+
 class SPSSLabelList:
 	def __init__ (self, labels, variablesApplicable, nonInteger):
 		self.labels = labels
 		self.variablesApplicable = variablesApplicable
 		self.nonInteger = nonInteger
+		self.fingerprint = None
+		
+	def getContent (self):
+		return self.nonInteger, tuple (sorted (self.labels.items ()))
 				
+# Value distributions count each distinct value exactly until they hold cap
+# values. Beyond that they keep a HyperLogLog estimate of the number of
+# distinct values and Misra-Gries counters for the most frequent ones
+# (decremented in batches, so counts are low by at most cases / heavyHitterCount), so
+# sizing memory doesn't grow with the number of cases. Values missing from
+# the label dictionary, if any, are noted exactly either way.
+# Callers count values already present directly and add () new ones.
+
+hashMask = (1 << 64) - 1
+
+def mixedHash (value):
+	h = hash (value) & hashMask
+	h = ((h ^ (h >> 30)) * 0xBF58476D1CE4E5B9) & hashMask
+	h = ((h ^ (h >> 27)) * 0x94D049BB133111EB) & hashMask
+	return h ^ (h >> 31)
+	
+class ValueDistribution (dict):
+	def __init__ (self, cap=None, labels=None, heavyHitterCount=100, precision=12):
+		dict.__init__ (self)
+		self.cap = cap
+		self.labels = labels
+		self.hasUnlabelledValue = False
+		self.heavyHitterCount = heavyHitterCount
+		self.precision = precision
+		self.registers = None
+		
+	def isExact (self):
+		return self.registers is None
+		
+	def add (self, value):
+		if self.labels is not None and not self.labels.has_key (value):
+			self.hasUnlabelledValue = True
+		if self.registers is None:
+			if self.cap is None or len (self) < self.cap:
+				self [value] = 1
+				return
+			self._startSketch ()
+		self._addHash (value)
+		self [value] = 1
+		if len (self) > 2 * self.heavyHitterCount:
+			threshold = sorted (self.itervalues (), reverse=True) [self.heavyHitterCount]
+			for key, count in self.items ():
+				if count <= threshold:
+					del self [key]
+				else:
+					self [key] = count - threshold
+					
+	def _startSketch (self):
+		self.registers = [0] * (1 << self.precision)
+		for value in self:
+			self._addHash (value)
+		heavyHitters = sorted (self.iteritems (), key=lambda item: item [1],
+			reverse=True) [:self.heavyHitterCount]
+		self.clear ()
+		self.update (heavyHitters)
+		
+	def _addHash (self, value):
+		h = mixedHash (value)
+		register = h >> (64 - self.precision)
+		rank = min (65 - ((h << self.precision) & hashMask).bit_length (), 65 - self.precision)
+		if rank > self.registers [register]:
+			self.registers [register] = rank
+			
+	def distinctCount (self):
+		if self.registers is None:
+			return len (self)
+		m = len (self.registers)
+		estimate = 0.7213 / (1 + 1.079 / m) * m * m /\
+			sum ((2.0 ** -register for register in self.registers))
+		zeros = self.registers.count (0)
+		if estimate <= 2.5 * m and zeros:
+			estimate = m * math.log (float (m) / zeros)
+		return max (len (self), int (round (estimate)))
+		
+	def mostCommon (self, n=None):
+		return sorted (self.iteritems (), key=lambda item: item [1], reverse=True) [:n]
+		
+# Decoded text of a string variable, by raw value. Repeated values then
+# cost a dictionary lookup and share one unicode object. The cache is
+# disabled once it holds size distinct values, however evenly they are
+# used: below that, lookups stop missing once each value has been seen.
+
+class TextCache:
+	def __init__ (self, size=textCacheSize):
+		self.texts = {}
+		self.size = size
+		self.lookups = 0
+		self.misses = 0
+		self.enabled = True
+		
+	def lookup (self, value, convert, *arguments):
+		self.lookups += 1
+		text = self.texts.get (value)
+		if text is None:
+			text = self.add (value, convert (value, *arguments))
+		return text
+		
+	def add (self, value, text):
+		self.misses += 1
+		if text is not None:
+			self.texts [value] = text
+		if len (self.texts) >= self.size:
+			self.enabled = False
+			self.texts = {}
+		return text
+		
+	def hitRate (self):
+		if self.lookups == 0:
+			return 0.0
+		return 1.0 - float (self.misses) / self.lookups
+		
 class SAVVariable:
 	def __init__ (self, dataset, data, offset):
+		byteOrder = dataset.byteOrder
 		def nextInt32 (signed=False):
 			if signed:
-				format = signedLongFormat
+				format = byteOrder.signedLong
 			else:
-				format = longFormat
-			value = struct.unpack (format,
-				data [offset + self.SAVSize: offset + self.SAVSize + 4])[0]
+				format = byteOrder.long
+			value = format.unpack_from (data, offset + self.SAVSize)[0]
 			self.SAVSize += 4
 			return value
 		def nextN (n):
@@ -180,15 +826,15 @@ class SAVVariable:
 			self.SAVSize += n
 			return value
 		def nextNBytes (n=1):
-			value = struct.unpack ('%s%db' % (endianityChar, n),
-				data [offset + self.SAVSize: offset + self.SAVSize + n])
+			value = struct.unpack_from ('%s%db' % (byteOrder.char, n),
+				data, offset + self.SAVSize)
 			self.SAVSize += n
 			return value
 		def nextNFloat (n=1, adjust=False):
 			# print "nextNFloat", n, adjust, self.SAVSize, offset
-			values = [unpackFloat (data[offset + i:offset + i + 8])\
+			values = [byteOrder.double.unpack_from (data, offset + i) [0]\
 				for i in xrange (self.SAVSize, self.SAVSize + 8*n, 8)]
-			#values = struct.unpack ('%s%dd' % (endianityChar, n),
+			#values = struct.unpack ('%s%dd' % (byteOrder.char, n),
 			#		data [offset + self.SAVSize: offset + self.SAVSize + 8*n])
 			self.SAVSize += 8*n
 			if adjust:
@@ -218,6 +864,7 @@ class SAVVariable:
 			self.missing_values = nextNFloat (abs (self.n_missing_values), False)
 			#self.missing_values = nextNFloat (abs (self.n_missing_values), True)
 		self.isDummy = False
+		self.isExcluded = False
 		self.stringLength = self.type_
 		self.extendedStringLength = None
 		self.longName = self.name
@@ -226,6 +873,27 @@ class SAVVariable:
 		self.width = None
 		self.alignment = None
 		self.fullPosition = None		
+		self.isMultiple = False
+		self.isSized = False
+		
+	# Statistics gathered by SAVDataset.sizeVariables. A lazily opened dataset
+	# gathers them, for every variable not yet sized, on first use.
+	
+	sizingAttributes = ("valueDistribution", "maxActualLength", "min", "max",
+		"sensibleLength", "partialCoding")
+		
+	def __getattr__ (self, name):
+		if name in SAVVariable.sizingAttributes and not self.isSized:
+			self.dataset.sizeVariables ([variable for variable in self.dataset.variables
+				if not variable.isSized])
+			if self.__dict__.has_key (name):
+				return self.__dict__ [name]
+		raise AttributeError, name
+		
+	def __getstate__ (self):
+		state = self.__dict__.copy ()
+		del state ["dataset"]
+		return state
 		
 	def isValidMissingValue (self, value):
 		if self.n_missing_values == 0: return False
@@ -264,9 +932,58 @@ class SAVVariable:
 		if self.has_var_label: repn += "; Label=%s" % (forceEncoding (self.label))
 		return repn
 		
+# Case selection: every-th case (counting from the first), or a random
+# fraction of the cases, or both, up to a limit. Random choices depend only
+# on the seed and the case number, so they are reproducible and don't depend
+# on where reading starts. Cases left out are skipped, not decoded, and
+# reading stops once the limit is reached.
+
+class CaseSelection:
+	def __init__ (self, limit=None, every=None, fraction=None, seed=0):
+		self.limit = limit
+		self.every = every
+		self.fraction = fraction
+		self.seed = seed
+		if fraction is not None:
+			self.threshold = int (fraction * (1 << 53))
+			
+	def getKey (self):
+		return self.limit, self.every, self.fraction, self.seed
+		
+	# The numbers of the cases selected from start on, regardless of the limit
+	
+	def getCases (self, start=0):
+		every = self.every or 1
+		case = (start + every - 1) / every * every
+		while True:
+			if self.includes (case):
+				yield case
+			case += every
+			
+	def includes (self, case):
+		if self.every is not None and case % self.every:
+			return False
+		if self.fraction is not None and\
+			mixedHash ((self.seed << 32) + case) >> 11 >= self.threshold:
+			return False
+		return True
+		
+	def __str__ (self):
+		parts = []
+		if self.every is not None:
+			parts.append ("1 case in %d" % self.every)
+		if self.fraction is not None:
+			parts.append ("a random %g of them (seed %d)" % (self.fraction, self.seed))
+		if self.limit is not None:
+			parts.append ("up to %d case(s)" % self.limit)
+		return ", ".join (parts) or "all cases"
+		
 class SAVDataset:
 
-	def __init__ (self, SAVFilename, sensibleStringLengths=True):
+	def __init__ (self, SAVFilename, sensibleStringLengths=True, memoryMap=True,
+		inflateThreads=4, spool=False, spoolDirectory=None, saveCaseIndex=True,
+		lazy=False, distributionCap=defaultDistributionCap, cache=None, sampleSize=None,
+		selection=None, caseSelection=None):
 		self.lowest = 0
 		self.highest = 0
 		self.floating_point_rep = 1
@@ -279,12 +996,10 @@ class SAVDataset:
 			return_type = None
 			# print "getRecordType", self.offset, len (self.binData)
 			if self.offset + 4 <= len (self.binData):
-				record_type = struct.unpack(longFormat,
-					self.binData[self.offset: self.offset+4])[0]
+				record_type = self.byteOrder.long.unpack_from (self.binData, self.offset)[0]
 				if record_type == 7:
 					self.offset += 4
-					sub_type = struct.unpack(longFormat,
-						self.binData[self.offset:self.offset+4])[0]
+					sub_type = self.byteOrder.long.unpack_from (self.binData, self.offset)[0]
 					return_type = "%d.%d" % (record_type, sub_type)
 				else:
 					return_type = "%d" % record_type
@@ -298,27 +1013,63 @@ class SAVDataset:
 				raise SAVError, "Unexpected EOF looking for %s at self.offset %d (X%x)" %\
 					(required, self.offset, self.offset)
 					
-		binFile = open(SAVFilename, 'rb')
-		self.binData = binFile.read()
-		binFile.close ()
+		if hasattr (SAVFilename, "read"):
+			self.source = StreamSource (SAVFilename)
+			SAVFilename = self.source.name
+			cache = None
+		else:
+			wrappedFile = openWrappedFile (SAVFilename)
+			if wrappedFile is not None:
+				self.source = StreamSource (wrappedFile, SAVFilename, closeStream=True,
+					opener=lambda: openWrappedFile (SAVFilename))
+			else:
+				self.source = None
+		if self.source is not None:
+			if self.source.opener is None:
+				spool = True
+			saveCaseIndex = False
+		self.filename = SAVFilename
+		self.inflateThreads = inflateThreads
+		self.spool = spool
+		self.spoolDirectory = spoolDirectory
+		self.spoolFile = None
+		self.spoolErrorTreatment = None
+		self.decodePlans = {}
+		self.caseIndex = None
+		self.saveCaseIndex = saveCaseIndex
+		self.distributionCap = distributionCap
+		self.sampleSize = sampleSize
+		self.selection = selection
+		self.caseSelection = caseSelection
+		self.sizedFromSample = False
+		self.textCaches = None
+		self.activeTextCaches = None
+		self.memoryMap = memoryMap
+		if self.source is not None:
+			self.binData = self.source.readDictionary ()
+		else:
+			self.binData = openBinData (SAVFilename, memoryMap)
 		self.sensibleStringLengths = sensibleStringLengths
 
 		rec_type = self.binData[:4]
-		if rec_type != "$FL2": raise SAVError,\
+		if rec_type not in ("$FL2", "$FL3"): raise SAVError,\
 			"Unknown file header record type %s" %  rec_type
 		self.prod_name = self.binData[4:64]
-		if struct.unpack('>L', self.binData [64:68])[0] in (2, 3):
-		      setBig()
-		elif struct.unpack('<L', self.binData[64:68])[0] in (2, 3):
-		      setLittle()
-		else:
-		      raise QBError, "--Can't determine layout code and end-ianity"
-		self.layout_code = struct.unpack(longFormat, self.binData[64:68])[0]
-		self.nominal_case_size = struct.unpack(longFormat, self.binData[68:72])[0]
-		self.compressed = struct.unpack(longFormat, self.binData[72:76])[0]
-		self.weight_index = struct.unpack(longFormat, self.binData[76:80])[0]
-		self.ncases = struct.unpack(longFormat, self.binData[80:84])[0]
-		bias = struct.unpack(floatFormat, self.binData[84:92])[0]
+		self.byteOrder = detectByteOrder (self.binData)
+		if cache is not None and cache.restore (self):
+			print "..Dictionary and statistics for %s restored from cache" % SAVFilename
+			if not lazy:
+				unsized = [variable for variable in self.variables if not variable.isSized]
+				if unsized:
+					self.sizeVariables (unsized)
+					cache.store (self)
+			return
+		self.layout_code = self.byteOrder.long.unpack_from (self.binData, 64)[0]
+		self.nominal_case_size = self.byteOrder.long.unpack_from (self.binData, 68)[0]
+		self.compressed = self.byteOrder.long.unpack_from (self.binData, 72)[0]
+		self.weight_index = self.byteOrder.long.unpack_from (self.binData, 76)[0]
+		self.ncases = self.byteOrder.long.unpack_from (self.binData, 80)[0]
+		bias = self.byteOrder.double.unpack_from (self.binData, 84)[0]
 		if float(int(bias)) != bias:
 			raise SAVError, "Non-integer bias value %f" % bias
 		self.bias = int (bias)
@@ -339,8 +1090,8 @@ class SAVDataset:
 			self.offset += newVariable.SAVSize
 			dummyVariableCount = 0
 			while self.offset < len (self.binData) - 7 and\
-				struct.unpack(longFormat, self.binData[self.offset:self.offset+4])[0] == 2 and\
-				struct.unpack(signedLongFormat, self.binData[self.offset+4:self.offset+8])[0]	 < 0:
+				self.byteOrder.long.unpack_from (self.binData, self.offset)[0] == 2 and\
+				self.byteOrder.signedLong.unpack_from (self.binData, self.offset+4)[0]	 < 0:
 				self.offset += 4
 				dummyVariable = SAVVariable (self, self.binData, self.offset)
 				dummyVariableCount += 1
@@ -354,15 +1105,16 @@ class SAVDataset:
 			# print "Variable", self.totalVariables, newVariable.name, newVariable.dummyVariables
 		
 		self.labelLists = []
+		labelListFingerprints = {}
 		while rec_type == '3':
 			labelList = {}
-			label_count = struct.unpack(longFormat, self.binData[self.offset:self.offset+4])[0]
+			label_count = self.byteOrder.long.unpack_from (self.binData, self.offset)[0]
 			self.offset += 4
 			nonInteger = False
 			for i in xrange (label_count):
-				value = struct.unpack(floatFormat, self.binData [self.offset: self.offset + 8])[0]
+				value = self.byteOrder.double.unpack_from (self.binData, self.offset)[0]
 				self.offset += 8
-				label_length = struct.unpack ('%sb' % endianityChar, self.binData [self.offset: self.offset + 1]) [0]
+				label_length = struct.unpack_from ('%sb' % self.byteOrder.char, self.binData, self.offset) [0]
 				label = self.binData [self.offset+1: self.offset+1+label_length]
 				if float (int (value)) != value:
 					# raise SAVError, "Non-integer labelled value; %s: %s" % (value, label)
@@ -378,30 +1130,35 @@ class SAVDataset:
 							(value, int (value), label)
 					labelList [int (value)] = label	# 0 codes supported for triple-S level 2+
 			getRecordType ("4")
-			var_count = struct.unpack(longFormat, self.binData[self.offset:self.offset+4])[0]
+			var_count = self.byteOrder.long.unpack_from (self.binData, self.offset)[0]
 			self.offset += 4
-			format = "%s%dL" % (endianityChar, var_count)
-			applicableVariables = struct.unpack (format, self.binData [self.offset:self.offset+4*var_count])
+			format = "%s%dL" % (self.byteOrder.char, var_count)
+			applicableVariables = struct.unpack_from (format, self.binData, self.offset)
 			self.offset += 4*var_count
 			for variableIndex in applicableVariables:
 				variable = self.variables [self.fullVariableMap [variableIndex-1]]
 				variable.labelList = len (self.labelLists)
-			self.labelLists.append (SPSSLabelList (labelList, applicableVariables, nonInteger))
+			spssLabelList = SPSSLabelList (labelList, applicableVariables, nonInteger)
+			spssLabelList.fingerprint = labelListFingerprints.setdefault (spssLabelList.getContent (),
+				len (self.labelLists))
+			if spssLabelList.fingerprint != len (self.labelLists):
+				spssLabelList.labels = self.labelLists [spssLabelList.fingerprint].labels
+			self.labelLists.append (spssLabelList)
 			rec_type = getRecordType ()
 			
 		while rec_type is not None:
 			if rec_type == "6":	# Document record
-				self.n_lines = struct.unpack(longFormat, self.binData[self.offset:self.offset+4])[0]
+				self.n_lines = self.byteOrder.long.unpack_from (self.binData, self.offset)[0]
 				self.offset  += 4
 				self.lines = [self.binData[self.offset:self.offset+80]
 					for self.offset in xrange (self.offset, self.offset+80*(self.n_lines+1), 80)]
 				# print "Document record", self.n_lines, self.lines
 			
 			elif rec_type == "7.3":
-				self.floating_point_rep = struct.unpack(longFormat, self.binData[self.offset+24:self.offset+28])[0]
+				self.floating_point_rep = self.byteOrder.long.unpack_from (self.binData, self.offset+24)[0]
 				if self.floating_point_rep != 1: raise SAVError, "Unsupported floating point format %s" %\
 					self.floating_point_rep
-				self.character_code = struct.unpack(longFormat, self.binData[self.offset+36:self.offset+40])[0]
+				self.character_code = self.byteOrder.long.unpack_from (self.binData, self.offset+36)[0]
 				if self.character_code == 2:
 					# self.encoding = "ascii" some files lie about being 7-bit
 					self.encoding = "ISO-8859-1"
@@ -414,31 +1171,24 @@ class SAVDataset:
 				self.offset += 10 * 4	# Machine integer info				
 			
 			elif rec_type == "7.4":
-				self.sysmis = struct.unpack (floatFormat,
-					self.binData[self.offset+8:self.offset+16]) [0]
-				self.highest = struct.unpack (floatFormat,
-					self.binData[self.offset+16:self.offset+24]) [0]
-				self.lowest = struct.unpack (floatFormat,
-					self.binData[self.offset+24:self.offset+32]) [0]
+				self.sysmis = self.byteOrder.double.unpack_from (self.binData, self.offset+8) [0]
+				self.highest = self.byteOrder.double.unpack_from (self.binData, self.offset+16) [0]
+				self.lowest = self.byteOrder.double.unpack_from (self.binData, self.offset+24) [0]
 				self.offset += 32
 			
 			elif rec_type == "7.11":
 				self.offset += 4
-				self.vdp_count = struct.unpack(longFormat,
-					self.binData[self.offset:self.offset+4])[0]
+				self.vdp_count = self.byteOrder.long.unpack_from (self.binData, self.offset)[0]
 				self.offset += 4
 				vdpItemCount = self.vdp_count / len (self.variables)
 				variableIndex = 0
 				for vdpIndex in xrange (0, self.vdp_count, vdpItemCount):
-					measure = struct.unpack (longFormat,
-						self.binData[self.offset:self.offset+4]) [0]
+					measure = self.byteOrder.long.unpack_from (self.binData, self.offset) [0]
 					self.offset += 4
-					width = struct.unpack (longFormat,
-						self.binData[self.offset:self.offset+4]) [0]
+					width = self.byteOrder.long.unpack_from (self.binData, self.offset) [0]
 					self.offset += 4
 					if vdpItemCount > 2:
-						alignment = struct.unpack (longFormat,
-							self.binData[self.offset:self.offset+4]) [0]
+						alignment = self.byteOrder.long.unpack_from (self.binData, self.offset) [0]
 						self.offset += 4
 					else:
 						alignment = None
@@ -449,8 +1199,7 @@ class SAVDataset:
 			
 			elif rec_type == "7.13":
 				self.offset += 4
-				bytes = struct.unpack (longFormat,
-					self.binData[self.offset:self.offset+4]) [0]
+				bytes = self.byteOrder.long.unpack_from (self.binData, self.offset) [0]
 				self.offset += 4
 				for name, longName in (pair.split ("=") for pair in
 					self.binData [self.offset:self.offset+bytes].split ("\t")):
@@ -459,8 +1208,7 @@ class SAVDataset:
 			
 			elif rec_type == "7.14":
 				self.offset += 4
-				bytes = struct.unpack (longFormat,
-					self.binData[self.offset:self.offset+4]) [0]
+				bytes = self.byteOrder.long.unpack_from (self.binData, self.offset) [0]
 				self.offset += 4
 				for name, stringLengthText in (pair.split ("=") for pair in
 					self.binData [self.offset:self.offset+bytes].split ("\t") if len(pair) > 1):
@@ -491,10 +1239,8 @@ class SAVDataset:
 				self.offset += bytes
 				
 			elif rec_type.startswith ("7"):
-				size = struct.unpack (longFormat,
-					self.binData[self.offset:self.offset+4]) [0]
-				count = struct.unpack (longFormat,
-					self.binData[self.offset+4:self.offset+8]) [0]
+				size = self.byteOrder.long.unpack_from (self.binData, self.offset) [0]
+				count = self.byteOrder.long.unpack_from (self.binData, self.offset+4) [0]
 				self.offset += 8 + size * count
 				
 			elif rec_type == "999":
@@ -532,123 +1278,522 @@ class SAVDataset:
 					variable.name = variable.longName
 					self.variableMap [variable.name] = variable
 			
-		for list_ in self.labelLists:
+		for index, list_ in enumerate (self.labelLists):
+			if list_.fingerprint != index: continue	# labels shared with an earlier list
 			for value, label in list_.labels.items ():
 				list_.labels [value] = self.convertText (label)
+				
+		if selection is not None:
+			self.selectVariables (selection)
 
 		self.dataOffset = self.offset
-		self.dataSize = len (self.binData) - self.dataOffset
-		print "..Data section starts at offset %d (X%x), size %d byte(s)" %\
-			(self.offset, self.offset, self.dataSize)
+		if self.source is not None:
+			self.dataSize = None
+			print "..Data section starts at offset %d (X%x), read from %s" %\
+				(self.offset, self.offset, self.filename)
+			if self.compressed == 2:
+				self.binData = self.source.readHead (self.dataOffset + 24)
+				self.zlibDataEnd = self._readZlibHeader () [0]
+				self.zlibBlocks = None
+		else:
+			self.dataSize = len (self.binData) - self.dataOffset
+			print "..Data section starts at offset %d (X%x), size %d byte(s)" %\
+				(self.offset, self.offset, self.dataSize)
+			if self.compressed == 2:
+				self._readZlibIndex ()
+				print "..ZLIB-compressed data in %d block(s), %d byte(s) when inflated" %\
+					(len (self.zlibBlocks), self.dataSize)
 
-		self.sizeVariables ()
+		if not lazy:
+			self.sizeVariables ()
+		if cache is not None:
+			cache.store (self)
+	
+	# Datasets are pickled to hand them to worker processes: the file is
+	# reopened on arrival and decode plans (closures) are rebuilt on demand
+	
+	def __getstate__ (self):
+		state = self.__dict__.copy ()
+		state ["binData"] = None
+		state ["spoolFile"] = None
+		state ["decodePlans"] = {}
+		state ["textCaches"] = None
+		state ["activeTextCaches"] = None
+		state ["byteOrder"] = None
+		state ["source"] = None
+		return state
 		
-		for i, variable in enumerate (self.variables):
-			if variable.labelList is not None:
-				labelDictionary = self.labelLists [variable.labelList].labels
-				for key in variable.valueDistribution:
-					if not labelDictionary.has_key (key):
-						#print "--No label for value %s of variable %s, list size: %d" %\
-						#	(key, variable.name, len (labelDictionary))
-						variable.partialCoding = True
-						break
-				else:
-					variable.partialCoding = False
+	def __setstate__ (self, state):
+		self.__dict__.update (state)
+		for variable in self.variables:
+			variable.dataset = self
+		self.binData = openBinData (self.filename, self.memoryMap)
+		self.byteOrder = detectByteOrder (self.binData)
+		
+	# A forked worker process inherits the spool file, whose file offset it
+	# would share with the parent and the other workers, so it drops it along
+	# with the decode plans and text caches, and decodes its cases afresh
 	
-	def getCaseStream (self, errorTreatment="ignore"):
+	def resetProcessState (self):
+		self.spoolFile = None
+		self.decodePlans = {}
+		self.textCaches = None
+		self.activeTextCaches = None
+		
+	def getCaseStream (self, errorTreatment="ignore", start=0, stop=None):
 		errorTreatment = errorTreatment.lower ()
+		if self.spoolFile is not None and\
+			errorTreatment in ("ignore", self.spoolErrorTreatment):
+			valueStream = self._getSpooledValueStream (start, stop)
+		elif self.spool and (self.compressed != 0 or self.source is not None) and\
+			self.spoolFile is None and\
+			start == 0 and stop is None:
+			valueStream = self._spoolValueStream (self._getValueStream (errorTreatment), errorTreatment)
+		else:
+			valueStream = self._getValueStream (errorTreatment, start, stop)
+		for variableValues in valueStream:
+			yield self._combineDummies (variableValues, errorTreatment)
+			
+	# Spooling: the first complete pass over compressed data, or over any data
+	# read from a stream (normally the sizing pass), writes every case's
+	# decoded values to a temporary file, and later passes read them back from
+	# it rather than decompressing (or reading) again
+	
+	def _spoolValueStream (self, valueStream, errorTreatment):
+		spoolFile = tempfile.TemporaryFile (dir=self.spoolDirectory)
+		complete = False
+		try:
+			for variableValues in valueStream:
+				marshal.dump (variableValues, spoolFile, 2)
+				yield variableValues
+			complete = True
+		finally:
+			if complete:
+				spoolFile.flush ()
+				self.spoolFile = spoolFile
+				self.spoolErrorTreatment = errorTreatment
+				print "..Decoded values spooled, %d byte(s)" % spoolFile.tell ()
+			else:
+				spoolFile.close ()
+				
+	def _readSpoolFile (self):
+		spoolFile = self.spoolFile
+		spoolFile.seek (0)
+		while True:
+			try:
+				yield marshal.load (spoolFile)
+			except EOFError:
+				return
+				
+	# The spool holds the cases selected, in order, so their case numbers
+	# are those the selection yields
+	
+	def _getSpooledValueStream (self, start=0, stop=None):
+		if self.caseSelection is None:
+			for variableValues in itertools.islice (self._readSpoolFile (), start, stop):
+				yield variableValues
+			return
+		for case, variableValues in itertools.izip (self.caseSelection.getCases (), self._readSpoolFile ()):
+			if stop is not None and case >= stop:
+				return
+			if case >= start:
+				yield variableValues
+				
+	def _getValueStream (self, errorTreatment, start=0, stop=None):
 		if self.compressed == 0:
-			raise SAVError, "Uncompressed data files not supported"
-		else:	
-			variablePosition = 0
-			case = 0
+			if numpy is not None and self.source is None:
+				for variableValues in self._getUncompressedValueStream (errorTreatment, start, stop):
+					yield variableValues
+				return
+			itemStream = self._getUncompressedItemStream (start)
+		elif start == 0:
 			itemStream = self._getDataItemStream ()
-		dataItem = itemStream.next ()
-		variableValues = [None]* len (self.variables)
+		else:
+			syncPoint = self.seekCase (start)
+			if syncPoint is None:
+				return
+			case, startOffset, skipItems = syncPoint
+			itemStream = self._getDataItemStream (startOffset, skipItems)
+		plan = self.getDecodePlan (errorTreatment)
+		decoders = plan.decoders
+		firstDecoder = decoders [0]
+		otherDecoders = decoders [1:]
+		firstSkipper = plan.skippers [0]
+		otherSkippers = plan.skippers [1:]
+		selection = self.caseSelection
+		nextItem = itemStream.next
+		case = start
+		caseCount = 0
+		while True:
+			if selection is not None and caseCount == selection.limit:
+				break
+			if stop is not None and case >= stop:
+				break
+			try:
+				dataItem = nextItem ()
+			except StopIteration:
+				break
+			if selection is not None and not selection.includes (case):
+				try:
+					firstSkipper (dataItem, nextItem, case)
+					for skipper in otherSkippers:
+						skipper (nextItem (), nextItem, case)
+				except StopIteration:
+					raise SAVError, "Incomplete case %d" % case
+				case = case + 1
+				continue
+			try:
+				variableValues = [firstDecoder (dataItem, nextItem, case)]
+				for decoder in otherDecoders:
+					variableValues.append (decoder (nextItem (), nextItem, case))
+			except StopIteration:
+				raise SAVError, "Incomplete case, before variable %s" %\
+					(self.variables [len (variableValues)].name,)
+			case = case + 1
+			caseCount = caseCount + 1
+			yield variableValues
+		#print "..End of data, case(s) %d" % case
+		
+	def getDecodePlan (self, errorTreatment="ignore"):
+		errorTreatment = errorTreatment.lower ()
+		if not self.decodePlans.has_key (errorTreatment):
+			self.decodePlans [errorTreatment] = DecodePlan (self, errorTreatment)
+		return self.decodePlans [errorTreatment]
+		
+	# Numeric values stored as raw 8-byte floats: only date formats need conversion
+	def _convertRawValue (self, variable, value, case, errorTreatment):
 		try:
-			while True:	
-				variable = self.variables [variablePosition]
-				#print variable.name, variable.type_, type (dataItem)
-				if variable.type_ == 0:
-					if type (dataItem) in (unicode, str):
-						#value = adjustedValue (struct.unpack (floatFormat, dataItem) [0])
-						value = struct.unpack (floatFormat, dataItem) [0]
-						#print "%s: %016x%016x %f" %\
-						#	(variable.name, struct.unpack (longFormat, dataItem[0:4]) [0],
-						#	 struct.unpack (longFormat, dataItem[4:]) [0],
-						#	 value)
-						try:
-							formatType = variable.write_.format_type
-							if formatType in\
-								(dateFormatCode, timeFormatCode, datetimeFormatCode):
-								value = datetime.datetime.fromtimestamp (value - SPSSEpochalDeltaSeconds).isoformat ()
-								if   formatType == dateFormatCode: value = value [0:10]
-								elif formatType == timeFormatCode: value = value [11:19]
-						except exceptions.Exception, e:
-							t = self.et (value)
-							if errorTreatment == "abort":
-								raise SAVError, "Can't interpret time for %s (%s) at case %d" %\
-								 	(variable.name, t, case)
-							elif errorTreatment == "report":
-								print "--Can't interpret time for %s (%s) at case %d" %\
-									(variable.name, t, case)
-							else:
-								pass
+			formatType = variable.write_.format_type
+			if formatType in\
+				(dateFormatCode, timeFormatCode, datetimeFormatCode):
+				value = datetime.datetime.fromtimestamp (value - SPSSEpochalDeltaSeconds).isoformat ()
+				if   formatType == dateFormatCode: value = value [0:10]
+				elif formatType == timeFormatCode: value = value [11:19]
+		except exceptions.Exception, e:
+			t = self.et (value)
+			if errorTreatment == "abort":
+				raise SAVError, "Can't interpret time for %s (%s) at case %d" %\
+				 	(variable.name, t, case)
+			elif errorTreatment == "report":
+				print "--Can't interpret time for %s (%s) at case %d" %\
+					(variable.name, t, case)
+			else:
+				pass
+		return value
+		
+	# Numeric values stored as compression codes (or system missing)
+	def _checkCodedValue (self, variable, value, case, errorTreatment):
+		if value is not None:
+			if variable.isValidMissingValue (value):
+				value = None
+			elif variable.labelList is not None:
+				try:
+					if value < 0 or float (int (value)) != value:
+						if errorTreatment == "abort":
+						 raise SAVError, "Only missing labelled values may be negative (variable %s, value %s)" %\
+						 	(variable.name, value)
+						elif errorTreatment == "report":
+							print "--Only missing labelled values may be negative (variable %s, value %s) at case %d" %\
+								(variable.name, value, case)
+						else:
+							pass
+						value = None
+				except exceptions.Exception, e:
+					t = self.et (value)
+					value = None
+					if errorTreatment == "abort":
+					 raise SAVError, "Exception interpreting '%s' (%s) at case %d; %s" %\
+					 	(variable.name, t, case, e)
+					elif errorTreatment == "report":
+						print "--Exception interpreting '%s' (%s) at case %d; %s" %\
+							(variable.name, t, case, e)
 					else:
-						value = dataItem
-						if value is not None:
-							if variable.isValidMissingValue (value):
-								value = None
-							elif variable.labelList is not None:
-								try:
-									if value < 0 or float (int (value)) != value:
-										if errorTreatment == "abort":
-										 raise SAVError, "Only missing labelled values may be negative (variable %s, value %s)" %\
-										 	(variable.name, value)
-										elif errorTreatment == "report":
-											print "--Only missing labelled values may be negative (variable %s, value %s) at case %d" %\
-												(variable.name, value, case)
-										else:
-											pass
-										value = None
-								except exceptions.Exception, e:
-									t = self.et (value)
-									value = None
-									if errorTreatment == "abort":
-									 raise SAVError, "Exception interpreting '%s' (%s) at case %d; %s" %\
-									 	(variable.name, t, case, e)
-									elif errorTreatment == "report":
-										print "--Exception interpreting '%s' (%s) at case %d; %s" %\
-											(variable.name, t, case, e)
-									else:
-										pass
+						pass
+		return value
+		
+	# Uncompressed data: every case is nominal_case_size 8-byte slots, so the
+	# data section can be viewed in place as an array of fixed-size records.
+	# Numeric values that the bytecode compression would have stored as codes
+	# are treated as codes, so results don't depend on how the file was written.
+	
+	def getCaseDtype (self):
+		fields = []
+		for index, variable in enumerate (self.variables):
+			if variable.type_ == 0:
+				fields.append (("v%d" % index, self.byteOrder.char + "f8"))
+			else:
+				fields.append (("v%d" % index, "S%d" % ((variable.stringLength + 7) / 8 * 8)))
+		caseDtype = numpy.dtype (fields)
+		if caseDtype.itemsize != self.nominal_case_size * 8:
+			raise SAVError, "Variables occupy %d byte(s) but nominal case size is %d byte(s)" %\
+				(caseDtype.itemsize, self.nominal_case_size * 8)
+		return caseDtype
+		
+	def getCaseArray (self):
+		if self.compressed != 0:
+			raise SAVError, "Case array only available for uncompressed data files"
+		if self.source is not None:
+			raise SAVError, "Case array not available for data read from a stream"
+		caseDtype = self.getCaseDtype ()
+		return numpy.frombuffer (self.binData, caseDtype,
+			self.dataSize / caseDtype.itemsize, self.dataOffset)
+			
+	def _getUncompressedValueStream (self, errorTreatment, start=0, stop=None, batchSize=4096):
+		cases = self.getCaseArray ()
+		end = len (cases)
+		if stop is not None:
+			end = min (end, stop)
+		sysmis = self.sysmis or defaultSysmis
+		lowestCode = 1 - self.bias
+		highestCode = 251 - self.bias
+		plan = self.getDecodePlan (errorTreatment)
+		numerics = [(position, plan.codedCheckers [position], plan.rawConverters [position])
+			for position in xrange (len (self.variables))
+				if plan.rawConverters [position] is not None and not self.variables [position].isExcluded]
+		selection = self.caseSelection
+		caseCount = 0
+		for batchStart in xrange (start, end, batchSize):
+			batchEnd = min (batchStart + batchSize, end)
+			if selection is None:
+				batch = enumerate (cases [batchStart: batchEnd].tolist (), batchStart)
+			else:
+				if caseCount == selection.limit:
+					return
+				selected = [case for case in xrange (batchStart, batchEnd)
+					if selection.includes (case)]
+				if selection.limit is not None:
+					selected = selected [:selection.limit - caseCount]
+				caseCount += len (selected)
+				batch = zip (selected, cases [selected].tolist ())
+			for case, record in batch:
+				variableValues = list (record)
+				for position, checkCoded, convertRaw in numerics:
+					value = variableValues [position]
+					if value == sysmis:
+						variableValues [position] = None
+					elif lowestCode <= value <= highestCode and value == int (value):
+						variableValues [position] = checkCoded (int (value), case)
+					else:
+						variableValues [position] = convertRaw (value, case)
+				yield variableValues
+				
+	def _getUncompressedItemStream (self, start=0):
+		sysmis = self.sysmis or defaultSysmis
+		lowestCode = 1 - self.bias
+		highestCode = 251 - self.bias
+		numericSlots = []
+		for variable in self.variables:
+			if variable.type_ == 0:
+				numericSlots.append (not variable.isExcluded)
+			else:
+				numericSlots.extend ([False] * ((variable.stringLength + 7) / 8))
+		caseSize = 8 * len (numericSlots)
+		unpack = self.byteOrder.double.unpack
+		pending = ""
+		for chunk, final in self._getDataChunks (start * caseSize):
+			data = pending + chunk
+			dataEnd = len (data) / caseSize * caseSize
+			for caseOffset in xrange (0, dataEnd, caseSize):
+				for slot, isNumeric in enumerate (numericSlots):
+					item = data [caseOffset + 8*slot: caseOffset + 8*slot + 8]
+					if isNumeric:
+						value = unpack (item) [0]
+						if value == sysmis:
+							item = None
+						elif lowestCode <= value <= highestCode and value == int (value):
+							item = int (value)
+					yield item
+			pending = data [dataEnd:]
+				
+	# Columnar access: getCaseBatches yields CaseBatch objects holding one
+	# column per requested variable for up to batchSize cases at a time.
+	# Compressed data is decoded in bulk and, since every case occupies
+	# exactly nominal_case_size data items, reshaped into a case x item array
+	# from which columns are sliced.
+	
+	def getCaseBatches (self, batchSize=10000, variables=None, errorTreatment="ignore",
+		datetimes=False):
+		if numpy is None:
+			raise SAVError, "Case batches require NumPy"
+		errorTreatment = errorTreatment.lower ()
+		positions = self.variablePositions (variables)
+		plan = self.getDecodePlan (errorTreatment)
+		if self.compressed == 0:
+			cases = self.getCaseArray ()
+			for batchStart in xrange (0, len (cases), batchSize):
+				records = cases [batchStart: batchStart + batchSize]
+				yield self._makeUncompressedBatch (plan, positions, batchStart, records, datetimes)
+			return
+		itemOffsets = []
+		itemsPerCase = 0
+		for variable in self.variables:
+			itemOffsets.append (itemsPerCase)
+			itemsPerCase += plan.itemCounts [len (itemOffsets) - 1]
+		batchItems = batchSize * itemsPerCase
+		batchStart = 0
+		pendingCodes, pendingValues, pendingBytes = [], [], []
+		pendingItems = 0
+		for codes, values, itemBytes, final in self._getItemArrays ():
+			pendingCodes.append (codes)
+			pendingValues.append (values)
+			pendingBytes.append (itemBytes)
+			pendingItems += len (codes)
+			if pendingItems < batchItems and not final: continue
+			codes = numpy.concatenate (pendingCodes)
+			values = numpy.concatenate (pendingValues)
+			itemBytes = numpy.concatenate (pendingBytes)
+			usedItems = 0
+			while pendingItems - usedItems >= batchItems or\
+				(final and pendingItems - usedItems >= itemsPerCase):
+				caseCount = min (batchSize, (pendingItems - usedItems) / itemsPerCase)
+				endItem = usedItems + caseCount * itemsPerCase
+				yield self._makeCompressedBatch (plan, positions, itemOffsets, batchStart, datetimes,
+					codes [usedItems: endItem].reshape (caseCount, itemsPerCase),
+					values [usedItems: endItem].reshape (caseCount, itemsPerCase),
+					itemBytes [usedItems: endItem].reshape (caseCount, itemsPerCase, 8))
+				batchStart += caseCount
+				usedItems = endItem
+			pendingCodes, pendingValues, pendingBytes = [codes [usedItems:]], [values [usedItems:]], [itemBytes [usedItems:]]
+			pendingItems -= usedItems
+		if pendingItems > 0:
+			raise SAVError, "Incomplete case after case %d" % batchStart
+			
+	# Variable selection: only the variables whose names match one of the
+	# patterns (names or shell-style wildcards, in any case) are converted.
+	# The others become dummies marked as excluded, so they are neither
+	# sized nor laid out, and their data items are skipped, not decoded.
+	
+	def selectVariables (self, patterns):
+		selected = set ()
+		for pattern in patterns:
+			matches = [position for position, variable in enumerate (self.variables)
+				if not variable.isDummy and fnmatch.fnmatchcase (variable.name.lower (), pattern.lower ())]
+			if not matches:
+				raise SAVError, "No variable matches %s" % pattern
+			selected.update (matches)
+		variableCount = 0
+		for position, variable in enumerate (self.variables):
+			if variable.isDummy: continue
+			variableCount += 1
+			if position in selected: continue
+			segmentCount = variable.extendedStringLength and variable.segmentCount or 0
+			for segment in self.variables [position: position + segmentCount + 1]:
+				segment.isDummy = True
+				segment.isExcluded = True
+		print "..%d of %d variable(s) selected" % (len (selected), variableCount)
+		
+	def variablePositions (self, variables=None):
+		if variables is None:
+			return range (len (self.variables))
+		positions = []
+		for variable in variables:
+			if isinstance (variable, (int, long)):
+				positions.append (variable)
+			elif isinstance (variable, SAVVariable):
+				positions.append (self.variables.index (variable))
+			else:
+				for position, candidate in enumerate (self.variables):
+					if candidate.name == variable or candidate.longName == variable:
+						positions.append (position)
+						break
 				else:
-					#print variable.name, " string length ", variable.stringLength
-					extensionBlocks = "".join ((itemStream.next ()
-						for blockIndex in xrange ((variable.stringLength + 7) / 8 - 1)))
-					value = dataItem + extensionBlocks
-				variableValues [variablePosition] = value
-				variablePosition += 1
-				if variablePosition == len (self.variables):
-					variablePosition = 0
-					case = case + 1
-					#for position, value in enumerate (variableValues):
-					#	print case, position, self.variables [position].name, value
-					#print ",".join ((self.encodeVariableCSVValue (index)
-					#	for index in xrange (len (self.variables))
-					#		if not self.variables [index].isDummy))
-					yield self._combineDummies (variableValues, errorTreatment)
-					variableValues = [None]* len (self.variables)
-					#print "..Case %d completed" % case
-				dataItem = itemStream.next ()
-		except StopIteration, e:
-			pass
-			#print "Data loop ended: %s" % e
-		#print "..End of data, case(s) %d" % case
-		if variablePosition > 0:
-			raise SAVError, "Incomplete case, before variable %s" %\
-				(self.variables [variablePosition].name,)
-		return
+					raise SAVError, "No variable named %s" % variable
+		return positions
+		
+	def _getItemArrays (self):
+		floatDtype = numpy.dtype (self.byteOrder.char + 'f8')
+		pending = ""
+		for chunk, final in self._getDataChunks ():
+			data = pending + chunk
+			codes, values, slots, consumed = decodeBytecode (data, self.bias, floatDtype, final)
+			itemBytes = numpy.empty ((len (codes), 8), numpy.uint8)
+			itemBytes.fill (ord (blankItem [0]))
+			raw = numpy.flatnonzero (slots >= 0)
+			if len (raw):
+				byteArray = numpy.frombuffer (data + blankItem * 8, numpy.uint8)
+				itemBytes [raw] = byteArray [slots [raw] [:, None] + numpy.arange (8)]
+			pending = data [consumed:]
+			yield codes, values, itemBytes, final
+			
+	def _makeCompressedBatch (self, plan, positions, itemOffsets, batchStart, datetimes,
+		codes, values, itemBytes):
+		columns = {}
+		for position in positions:
+			itemOffset = itemOffsets [position]
+			if plan.rawConverters [position] is None:
+				itemCount = plan.itemCounts [position]
+				segments = numpy.ascontiguousarray (itemBytes [:, itemOffset: itemOffset + itemCount])\
+					.reshape (len (codes), 8 * itemCount)
+				columns [position] = CaseColumn (self.variables [position], plan.kinds [position],
+					segments.view ("S%d" % (8 * itemCount)).ravel ())
+			else:
+				columns [position] = self._makeNumericColumn (plan, position, batchStart,
+					codes [:, itemOffset], values [:, itemOffset], datetimes)
+		return CaseBatch (batchStart, len (codes), positions, columns)
+		
+	def _makeUncompressedBatch (self, plan, positions, batchStart, records, datetimes):
+		sysmis = self.sysmis or defaultSysmis
+		columns = {}
+		for position in positions:
+			field = records ["v%d" % position]
+			if plan.rawConverters [position] is None:
+				columns [position] = CaseColumn (self.variables [position], plan.kinds [position],
+					numpy.array (field))
+			else:
+				values = field.astype (numpy.float64)
+				coded = (values >= 1 - self.bias) & (values <= 251 - self.bias) &\
+					(values == numpy.floor (values))
+				codes = numpy.where (values == sysmis, 255, numpy.where (coded, 1, 253))
+				columns [position] = self._makeNumericColumn (plan, position, batchStart,
+					codes, values, datetimes)
+		return CaseBatch (batchStart, len (records), positions, columns)
+		
+	# Numeric columns follow the same rules as the case stream: codes are
+	# checked against missing values (and, if labelled, for negative values),
+	# raw values are not; dates are converted value by value through the plan
+	
+	def _makeNumericColumn (self, plan, position, batchStart, codes, values, datetimes):
+		variable = self.variables [position]
+		kind = plan.kinds [position]
+		coded = codes <= 251
+		mask = codes == 255
+		isMissing = plan.missingArrayTests [position]
+		if isMissing is not None:
+			mask |= coded & isMissing (values)
+		if kind in ("date", "time", "datetime") and datetimes:
+			values, invalid = plan.getDateDecoder (kind).decodeArray (values)
+			return CaseColumn (variable, kind, values, mask | invalid)
+		if kind in ("date", "time", "datetime"):
+			checkCoded = plan.codedCheckers [position]
+			convertRaw = plan.rawConverters [position]
+			column = []
+			for case, code, value in itertools.izip (itertools.count (batchStart),
+				codes.tolist (), values.tolist ()):
+				if code == 255:
+					column.append (checkCoded (None, case))
+				elif code <= 251:
+					column.append (checkCoded (int (value), case))
+				else:
+					column.append (convertRaw (value, case))
+			return CaseColumn (variable, kind, column)
+		if variable.labelList is not None:
+			negative = coded & ~mask & (values < 0)
+			for index in numpy.flatnonzero (negative).tolist ():
+				plan.codedCheckers [position] (int (values [index]), batchStart + index)
+			mask |= negative
+			if (values [~mask] == numpy.floor (values [~mask])).all ():
+				values = numpy.where (mask, 0, values).astype (numpy.int64)
+		return CaseColumn (variable, kind, values, mask)
+		
+	def close (self):
+		if self.source is not None:
+			self.source.close ()
+		if isinstance (self.binData, mmap.mmap):
+			self.binData.close ()
+		self.binData = None
+		if self.spoolFile is not None:
+			self.spoolFile.close ()
+			self.spoolFile = None
 		
 	def convertText (self, t, errorTreatment='ignore'):
 		if t is not None:
@@ -668,7 +1813,7 @@ class SAVDataset:
 		
 	def printMetadata (self, verbose=False):
 		print "..Product name is ", self.prod_name
-		print "..Layout code is %s, %s-endian" % (self.layout_code, endianity)
+		print "..Layout code is %s, %s-endian" % (self.layout_code, self.byteOrder.name)
 		print "..Nominal case size is %s" % self.nominal_case_size
 		print "..Compressed: %s" % self.compressed
 		print "..Weight index: %s" % self.weight_index
@@ -690,46 +1835,316 @@ class SAVDataset:
 						(i, variable.fullPosition+1, variable))
 			for i, l in enumerate (self.labelLists):
 				print "List: %d" % i, l.labels, l.variablesApplicable# , l.nonInteger
+			for variable, textCache in zip (self.variables, self.textCaches or []):
+				if textCache is not None and textCache.lookups:
+					print forceEncoding ("Text cache for %s: %d lookup(s), %.1f%% hits%s" %\
+						(variable.name, textCache.lookups, 100 * textCache.hitRate (),
+						 ("", " (disabled)") [not textCache.enabled]))
 	
-	def _getDataItemStream (self):
-		def getDataByte (offset):
-			byte = struct.unpack ('%sB' % endianityChar,
-				self.binData [self.dataOffset + offset: self.dataOffset + offset + 1]) [0]
-			#print "Byte @ %d=%s" % (offset, byte)
-			return byte
-		blockOffset = 0
-		while blockOffset + 8 <= self.dataSize:
-			#print "Block offset: ", blockOffset
-			finalBlockOffset = blockOffset + 8
-			for byteIndex in xrange (8):
-				byte = getDataByte (blockOffset + byteIndex)
-				if byte >= 1 and byte <= 251:
-					value = byte - self.bias
-					#print "Value %d (%s)" % (value, type (value))
-				elif byte == 0:
-					#print "Ignore"
-					continue
-				elif byte == 252:
-					#print "EOF"
-					continue
-				elif byte == 253:
-					value = self.binData [
-						self.dataOffset + finalBlockOffset:
-						self.dataOffset + finalBlockOffset + 8]
-					#print "Extension value: %s" % value
-					finalBlockOffset += 8
-				elif byte == 254:
-					value = "        "
-					#print "Blank 8"
-				elif byte == 255:
-					value = None
-					#print "Missing"
+	def _getDataItemStream (self, startOffset=0, skipItems=0):
+		if numpy is None:
+			return self._getDataItemStreamByByte (startOffset, skipItems)
+		return self._getBulkDataItemStream (startOffset, skipItems)
+		
+	# A sync point (case, offset, skipItems) says where a case starts in
+	# compressed data: the logical offset of the control block holding its
+	# first item, and how many items of that block belong to the previous case.
+	# Decoding can begin at any sync point, which lets case ranges be read
+	# independently.
+	
+	def getItemsPerCase (self):
+		itemsPerCase = 0
+		for variable in self.variables:
+			if variable.type_ == 0:
+				itemsPerCase += 1
+			else:
+				itemsPerCase += (variable.stringLength + 7) / 8
+		return itemsPerCase
+		
+	def findSyncPoints (self, every):
+		if self.compressed == 0:
+			raise SAVError, "Sync points only apply to compressed data files"
+		return [syncPoint for syncPoint in self._scanCaseStarts ()
+			if syncPoint [0] % every == 0]
+			
+	# The case index holds the sync point of every caseIndexInterval-th case.
+	# It is saved beside the data file, keyed by the file's size and
+	# modification time, so later runs can seek without scanning.
+	
+	def getCaseIndexFilename (self):
+		return self.filename + ".idx"
+		
+	def _getFileKey (self):
+		fileStatus = os.stat (self.filename)
+		return fileStatus.st_size, fileStatus.st_mtime
+		
+	def loadCaseIndex (self):
+		try:
+			indexFile = open (self.getCaseIndexFilename (), "rb")
+			try:
+				version, fileKey, every, syncPoints = marshal.load (indexFile)
+			finally:
+				indexFile.close ()
+		except (IOError, EOFError, ValueError, TypeError):
+			return None
+		if version != caseIndexVersion or fileKey != self._getFileKey ():
+			return None
+		return every, syncPoints
+		
+	def buildCaseIndex (self, every=None):
+		if every is None:
+			every = caseIndexInterval
+		caseIndex = every, self.findSyncPoints (every)
+		if self.saveCaseIndex:
+			try:
+				indexFile = open (self.getCaseIndexFilename (), "wb")
+				try:
+					marshal.dump ((caseIndexVersion, self._getFileKey ()) + caseIndex, indexFile, 2)
+				finally:
+					indexFile.close ()
+			except (IOError, OSError), e:
+				print "--Case index not saved (%s)" % e
+		return caseIndex
+		
+	def getCaseIndex (self):
+		if self.source is not None:
+			raise SAVError, "No case index for data read from a stream"
+		if self.caseIndex is None:
+			self.caseIndex = self.loadCaseIndex ()
+			if self.caseIndex is None:
+				self.caseIndex = self.buildCaseIndex ()
+				print "..Case index built, %d sync point(s)" % len (self.caseIndex [1])
+		return self.caseIndex
+		
+	# The sync point of any case: uncompressed cases are at fixed offsets,
+	# compressed ones are found by scanning on from the nearest indexed case.
+	# Returns None beyond the last case.
+	
+	def seekCase (self, case):
+		if self.source is not None:
+			raise SAVError, "Can't seek in data read from a stream"
+		if self.compressed == 0:
+			caseSize = 8 * self.nominal_case_size
+			if case * caseSize + caseSize > self.dataSize:
+				return None
+			return case, case * caseSize, 0
+		every, syncPoints = self.getCaseIndex ()
+		if not syncPoints:
+			return None
+		nearest = syncPoints [min (case / every, len (syncPoints) - 1)]
+		for syncPoint in self._scanCaseStarts (*nearest):
+			if syncPoint [0] == case:
+				return syncPoint
+		return None
+		
+	def getCaseRanges (self, rangeCount):
+		if self.source is not None:
+			raise SAVError, "Can't divide data read from a stream into case ranges"
+		if self.compressed == 0:
+			caseCount = self.dataSize / (8 * self.nominal_case_size)
+			starts = [caseCount * index / rangeCount for index in xrange (rangeCount)]
+		else:
+			syncPoints = self.getCaseIndex () [1] or [(0, 0, 0)]
+			starts = [syncPoints [len (syncPoints) * index / rangeCount] [0]
+				for index in xrange (rangeCount)]
+		starts = sorted (set (starts))
+		return zip (starts, starts [1:] + [None])
+		
+	def _scanCaseStarts (self, case=0, startOffset=0, skipItems=0):
+		itemsPerCase = self.getItemsPerCase ()
+		itemCount = case * itemsPerCase - skipItems
+		pending = ""
+		pendingOffset = startOffset
+		for chunk, final in self._getDataChunks (startOffset):
+			data = pending + chunk
+			dataSize = len (data)
+			blockOffset = 0
+			while blockOffset + 8 <= dataSize:
+				blockEnd = blockOffset + 8 + 8 * data.count ('\xfd', blockOffset, blockOffset + 8)
+				if blockEnd > dataSize and not final: break
+				block = data [blockOffset: blockOffset + 8]
+				blockStart = itemCount
+				itemCount += 8 - block.count ('\x00') - block.count ('\xfc')
+				while case * itemsPerCase < itemCount:
+					yield case, pendingOffset + blockOffset, case * itemsPerCase - blockStart
+					case += 1
+				blockOffset = blockEnd
+			pending = data [blockOffset:]
+			pendingOffset += blockOffset
+		
+	# ZSAV files hold the bytecode-compressed data section as a series of
+	# zlib blocks, indexed by a trailer that follows them
+	
+	def _readZlibHeader (self):
+		zheaderOffset, ztrailerOffset, ztrailerLength =\
+			self.byteOrder.zlibHeader.unpack_from (self.binData, self.dataOffset)
+		if zheaderOffset != self.dataOffset:
+			raise SAVError, "ZLIB header at offset %d claims offset %d" %\
+				(self.dataOffset, zheaderOffset)
+		return ztrailerOffset, ztrailerLength
+		
+	def _readZlibIndex (self):
+		ztrailerOffset, ztrailerLength = self._readZlibHeader ()
+		requireByes (self.binData, ztrailerOffset, ztrailerLength)
+		bias, zero, blockSize, blockCount =\
+			self.byteOrder.zlibBlock.unpack_from (self.binData, ztrailerOffset)
+		if -bias != self.bias:
+			raise SAVError, "ZLIB trailer bias %d inconsistent with compression bias %d" %\
+				(-bias, self.bias)
+		if 24 * (blockCount + 1) > ztrailerLength:
+			raise SAVError, "ZLIB trailer too short for %d block(s)" % blockCount
+		self.zlibBlocks = [self.byteOrder.zlibBlock.unpack_from
+			(self.binData, ztrailerOffset + 24 * (blockIndex + 1))
+				for blockIndex in xrange (blockCount)]
+		self.dataSize = sum ((uncompressedSize
+			for uncompressedOffset, compressedOffset, uncompressedSize, compressedSize
+				in self.zlibBlocks))
+		
+	# Blocks are inflated on a thread pool (zlib releases the interpreter lock)
+	# but only a few blocks ahead of the decoder, so the inflated data section
+	# is never held in memory as a whole
+	
+	def _getInflatedChunks (self, startOffset=0):
+		blocks = iter (self.zlibBlocks)
+		skip = startOffset
+		for uncompressedOffset, compressedOffset, uncompressedSize, compressedSize in self.zlibBlocks:
+			if skip < uncompressedSize: break
+			blocks.next ()
+			skip -= uncompressedSize
+		pool = ThreadPool (self.inflateThreads)
+		try:
+			pending = collections.deque ()
+			for block in itertools.islice (blocks, 2 * self.inflateThreads):
+				pending.append (pool.apply_async (inflateBlock, (self.binData, block)))
+			while pending:
+				chunk = pending.popleft ().get ()
+				for block in itertools.islice (blocks, 1):
+					pending.append (pool.apply_async (inflateBlock, (self.binData, block)))
+				if skip:
+					chunk, skip = chunk [skip:], 0
+				yield chunk, not pending
+		finally:
+			pool.terminate ()
+			
+	# Offsets into the data section are logical: for ZSAV files they count
+	# inflated bytes from the start of the first block
+	
+	def _getDataChunks (self, startOffset=0):
+		if self.source is not None:
+			if startOffset:
+				raise SAVError, "Can't seek in data read from a stream"
+			if self.compressed == 2:
+				chunks = self.source.getInflatedChunks (self.dataOffset + 24, self.zlibDataEnd)
+			else:
+				chunks = self.source.getChunks (self.dataOffset)
+			for chunk in chunks:
+				yield chunk
+			return
+		if self.compressed == 2:
+			for chunk in self._getInflatedChunks (startOffset):
+				yield chunk
+			return
+		for chunkOffset in xrange (startOffset, self.dataSize, bytecodeChunkSize):
+			chunkEnd = min (chunkOffset + bytecodeChunkSize, self.dataSize)
+			yield (self.binData [self.dataOffset + chunkOffset: self.dataOffset + chunkEnd],
+				chunkEnd == self.dataSize)
+			
+	def _getBulkDataItemStream (self, startOffset=0, skipItems=0):
+		floatDtype = numpy.dtype (self.byteOrder.char + 'f8')
+		bias = self.bias
+		pending = ""
+		for chunk, final in self._getDataChunks (startOffset):
+			data = pending + chunk
+			codes, values, slots, consumed = decodeBytecode (data, bias, floatDtype, final)
+			if skipItems:
+				skipped = min (skipItems, len (codes))
+				codes, slots = codes [skipped:], slots [skipped:]
+				skipItems -= skipped
+			items = (codes.astype (numpy.int64) - bias).tolist ()
+			special = numpy.flatnonzero (codes > 251)
+			for index, code, slot in itertools.izip (special.tolist (),
+				codes [special].tolist (), slots [special].tolist ()):
+				if code == 253:
+					items [index] = data [slot: slot + 8]
+				elif code == 254:
+					items [index] = blankItem
 				else:
-					raise SAVError, "Invalid compressed data value: %s" % byte
-				yield value
-			blockOffset = finalBlockOffset
+					items [index] = None
+			for item in items:
+				yield item
+			pending = data [consumed:]
+			
+	def _getDataItemStreamByByte (self, startOffset=0, skipItems=0):
+		pending = ""
+		for chunk, final in self._getDataChunks (startOffset):
+			data = pending + chunk
+			dataSize = len (data)
+			def getDataByte (offset):
+				byte = ord (data [offset])
+				#print "Byte @ %d=%s" % (offset, byte)
+				return byte
+			blockOffset = 0
+			while blockOffset + 8 <= dataSize:
+				#print "Block offset: ", blockOffset
+				if not final and\
+					blockOffset + 8 + 8 * data.count ('\xfd', blockOffset, blockOffset + 8) > dataSize:
+					break	# raw values continue in the next chunk
+				finalBlockOffset = blockOffset + 8
+				for byteIndex in xrange (8):
+					byte = getDataByte (blockOffset + byteIndex)
+					if byte >= 1 and byte <= 251:
+						value = byte - self.bias
+						#print "Value %d (%s)" % (value, type (value))
+					elif byte == 0:
+						#print "Ignore"
+						continue
+					elif byte == 252:
+						#print "EOF"
+						continue
+					elif byte == 253:
+						value = data [finalBlockOffset: finalBlockOffset + 8]
+						#print "Extension value: %s" % value
+						finalBlockOffset += 8
+					elif byte == 254:
+						value = blankItem
+						#print "Blank 8"
+					elif byte == 255:
+						value = None
+						#print "Missing"
+					else:
+						raise SAVError, "Invalid compressed data value: %s" % byte
+					if skipItems:
+						skipItems -= 1
+						continue
+					yield value
+				blockOffset = finalBlockOffset
+			pending = data [blockOffset:]
 			
+	# Identifies the dictionary, leaving out the header details (case count,
+	# creation date and time) that change from one wave of a survey to the next
+	
+	def getDictionaryFingerprint (self):
+		variables = [(variable.name, variable.longName, variable.type_, variable.label,
+			variable.n_missing_values, getattr (variable, "missing_values", None),
+			(variable.print_.format_type, variable.print_.width, variable.print_.dp),
+			(variable.write_.format_type, variable.write_.width, variable.write_.dp),
+			variable.isDummy, variable.extendedStringLength, variable.labelList)
+				for variable in self.variables]
+		labelLists = [(labelList.getContent (), labelList.variablesApplicable)
+			for labelList in self.labelLists]
+		return hashlib.sha1 (repr ((self.encoding, variables, labelLists))).hexdigest ()
+		
+	def getTextCaches (self):
+		if self.textCaches is None:
+			self.textCaches = [variable.type_ > 0 and not variable.isDummy and TextCache () or None
+				for variable in self.variables]
+			self.activeTextCaches = list (self.textCaches)
+		return self.textCaches
+		
 	def _combineDummies (self, variableValues, errorTreatment):
+		if self.activeTextCaches is None:
+			self.getTextCaches ()
+		textCaches = self.activeTextCaches
 		nonDummies = []
 		for index, variable in enumerate (self.variables):
 			if not variable.isDummy:
@@ -763,7 +2178,14 @@ class SAVDataset:
 								value = variableValues [index]
 					else:
 						value = variableValues [index]
-					nonDummies.append ((index, self.convertText (value, errorTreatment)))
+					textCache = textCaches [index]
+					if textCache is None:
+						text = self.convertText (value, errorTreatment)
+					else:
+						text = textCache.lookup (value, self.convertText, errorTreatment)
+						if not textCache.enabled:
+							textCaches [index] = None
+					nonDummies.append ((index, text))
 				else:
 					nonDummies.append ((index, variableValues [index]))
 		return nonDummies		
@@ -793,38 +2215,219 @@ class SAVDataset:
 		raise SAVError, "Value %s found with write format %s" %\
 			(value, formatCodeMap [variable.write_.format_type])
 			
-	def sizeVariables (self):
-		for variable in self.variables:
-			variable.valueDistribution = {}
+	# Sizing from a sample: the first half of sampleSize cases, then blocks of
+	# sampleBlockSize cases spread evenly over the rest of the file. Unless the
+	# file ends within the first half, the widths found are only estimates and
+	# the values converted must be checked against them. With a case
+	# selection, only the cases selected are counted. Data read from a
+	# stream is always sized in full, as the blocks can't be sought out,
+	# and so are cases selected up to a limit, which are few enough anyway.
+	
+	def isSizedFromSample (self):
+		return self.sampleSize is not None and self.source is None and\
+			(self.caseSelection is None or self.caseSelection.limit is None)
+			
+	def getSampleCaseStream (self, errorTreatment="ignore"):
+		headSize = max (1, self.sampleSize / 2)
+		self.sampledCaseCount = 0
+		self.sizedFromSample = False
+		for case in itertools.islice (self.getCaseStream (errorTreatment), headSize):
+			self.sampledCaseCount += 1
+			yield case
+		if self.sampledCaseCount < headSize:
+			return
+		self.sizedFromSample = True
+		if self.caseSelection is None:
+			headEnd = headSize
+		else:
+			headEnd = list (itertools.islice (self.caseSelection.getCases (), headSize)) [-1] + 1
+		blockCount = (self.sampleSize - headSize + sampleBlockSize - 1) / sampleBlockSize
+		for start, stop in self.getCaseRanges (blockCount + 1) [1:]:
+			start = max (start, headEnd)
+			if stop is not None and start >= stop: continue
+			for case in itertools.islice (self.getCaseStream (errorTreatment, start, stop), sampleBlockSize):
+				self.sampledCaseCount += 1
+				yield case
+			
+	def sizeVariables (self, variables=None):
+		positions = []
+		for position in self.variablePositions (variables):
+			if self.variables [position].isExcluded:
+				self.variables [position].isSized = True
+			else:
+				positions.append (position)
+		sizings = [None] * len (self.variables)
+		for position in positions:
+			variable = self.variables [position]
+			if variable.labelList is not None:
+				variable.valueDistribution = ValueDistribution (self.distributionCap,
+					self.labelLists [variable.labelList].labels)
+			else:
+				variable.valueDistribution = ValueDistribution (self.distributionCap)
 			if not variable.isDummy:
 				variable.maxActualLength = 0
 				if variable.type_ == 0:
 					variable.min = self.highest
 					variable.max = self.lowest
-				variable.isMultiple = False
-		stream = self.getCaseStream ("report")
+			if variable.isMultiple:
+				kind = "multiple"
+			elif variable.extendedStringLength or variable.type_ == 255:
+				kind = "long"
+			elif variable.type_ == 0:
+				kind = "numeric"
+			else:
+				kind = "string"
+			sizings [position] = (variable, variable.valueDistribution, kind)
+		if self.isSizedFromSample ():
+			stream = self.getSampleCaseStream ("report")
+		else:
+			stream = self.getCaseStream ("report")
 		for case in stream:
 			for (sequence, value) in case:
 				if value is None: continue
-				variable = self.variables [sequence]
-				if variable.valueDistribution.has_key (value):
-					variable.valueDistribution [value] += 1
+				sizing = sizings [sequence]
+				if sizing is None: continue
+				variable, distribution, kind = sizing
+				if kind == "multiple":
+					value = tuple (value)
+				if distribution.has_key (value):
+					distribution [value] += 1
 				else:
-					variable.valueDistribution [value] = 1
-				if variable.extendedStringLength or variable.type_ == 255:
+					distribution.add (value)
+				if kind == "long":
 					thisLength = len (value.rstrip ())
 					variable.maxActualLength =\
 						max (variable.maxActualLength, thisLength)
-				if variable.type_ == 0:
+				elif kind == "numeric":
 					variable.min = min (variable.min, value)
 					variable.max = max (variable.max, value)
 					# variable.max = 0
-		for variable in self.variables:
+		sketched = 0
+		for position in positions:
+			variable = self.variables [position]
 			if not variable.isDummy:
 				if variable.extendedStringLength or variable.type_ == 255:
 					variable.sensibleLength = 1
 					while variable.sensibleLength < variable.maxActualLength:
 						variable.sensibleLength *= 2
+			if variable.labelList is not None:
+				variable.partialCoding = variable.valueDistribution.hasUnlabelledValue
+			if not variable.valueDistribution.isExact ():
+				sketched += 1
+			variable.isSized = True
+		if self.isSizedFromSample ():
+			print "..Variables sized from a sample of %d case(s)%s" % (self.sampledCaseCount,
+				("", ", widths to be verified") [self.sizedFromSample])
+		if sketched:
+			print "..%d variable(s) with over %d distinct values, distributions estimated" %\
+				(sketched, self.distributionCap)
+				
+	# Sizing from the dictionary alone, when no pass over the data is wanted:
+	# with no values seen, numeric variables take the range of their write
+	# format, long strings their declared length, and labelled variables are
+	# taken to be fully coded
+	
+	def sizeFromDictionary (self):
+		for variable in self.variables:
+			if variable.labelList is not None:
+				variable.valueDistribution = ValueDistribution (self.distributionCap,
+					self.labelLists [variable.labelList].labels)
+				variable.partialCoding = False
+			else:
+				variable.valueDistribution = ValueDistribution (self.distributionCap)
+			if not variable.isDummy:
+				variable.maxActualLength = 0
+				if variable.type_ == 0:
+					variable.min = self.highest
+					variable.max = self.lowest
+				elif variable.extendedStringLength or variable.type_ == 255:
+					variable.sensibleLength = variable.extendedStringLength or variable.type_
+			variable.isSized = True
 						
+# Metadata cache: the parsed dictionary and sizing statistics of each data
+# file, pickled under a cache directory. Entries are found by absolute path
+# and used only if the file's size, modification time and dictionary bytes,
+# and the options that affect sizing, are unchanged. The least recently used
+# entries are removed once the directory holds more than maxSize bytes.
+
+runtimeAttributes = ("filename", "inflateThreads", "spool", "spoolDirectory",
+	"spoolFile", "spoolErrorTreatment", "decodePlans", "saveCaseIndex",
+	"distributionCap", "memoryMap", "binData", "sensibleStringLengths",
+	"textCaches", "activeTextCaches", "byteOrder", "source")
+	
+class MetadataCache:
+	def __init__ (self, directory, maxSize=defaultCacheSize):
+		self.directory = directory
+		self.maxSize = maxSize
+		
+	def getEntryFilename (self, filename):
+		return os.path.join (self.directory,
+			hashlib.sha1 (os.path.abspath (filename)).hexdigest () + ".cache")
+			
+	def getOptions (self, dataset):
+		return dataset.sensibleStringLengths, dataset.distributionCap, dataset.sampleSize,\
+			dataset.selection, dataset.caseSelection and dataset.caseSelection.getKey ()
+		
+	def getFingerprint (self, dataset, dataOffset):
+		fileStatus = os.stat (dataset.filename)
+		return (os.path.abspath (dataset.filename), fileStatus.st_size, fileStatus.st_mtime,
+			hashlib.sha1 (dataset.binData [:dataOffset]).hexdigest ())
+			
+	def restore (self, dataset):
+		entryFilename = self.getEntryFilename (dataset.filename)
+		try:
+			entryFile = open (entryFilename, "rb")
+			try:
+				version, fingerprint, options, state = cPickle.load (entryFile)
+			finally:
+				entryFile.close ()
+		except (IOError, EOFError, ValueError, TypeError, cPickle.UnpicklingError):
+			return False
+		if version != cacheVersion or options != self.getOptions (dataset) or\
+			fingerprint != self.getFingerprint (dataset, state ["dataOffset"]):
+			return False
+		dataset.__dict__.update (state)
+		for variable in dataset.variables:
+			variable.dataset = dataset
+		try:
+			os.utime (entryFilename, None)
+		except OSError:
+			pass
+		return True
+		
+	def store (self, dataset):
+		state = dataset.__getstate__ ()
+		for attribute in runtimeAttributes:
+			state.pop (attribute, None)
+		entryFilename = self.getEntryFilename (dataset.filename)
+		try:
+			if not os.path.isdir (self.directory):
+				os.makedirs (self.directory)
+			entryFile = tempfile.NamedTemporaryFile (dir=self.directory, delete=False)
+			try:
+				cPickle.dump ((cacheVersion, self.getFingerprint (dataset, dataset.dataOffset),
+					self.getOptions (dataset), state), entryFile, 2)
+			finally:
+				entryFile.close ()
+			if os.path.exists (entryFilename):
+				os.remove (entryFilename)
+			os.rename (entryFile.name, entryFilename)
+			self.evict ()
+		except (IOError, OSError, cPickle.PicklingError), e:
+			print "--Metadata cache not updated (%s)" % e
+			
+	def evict (self):
+		entries = []
+		for name in os.listdir (self.directory):
+			if name.endswith (".cache"):
+				fileStatus = os.stat (os.path.join (self.directory, name))
+				entries.append ((fileStatus.st_mtime, fileStatus.st_size, name))
+		entries.sort ()
+		totalSize = sum ((size for accessTime, size, name in entries))
+		for accessTime, size, name in entries:
+			if totalSize <= self.maxSize: break
+			os.remove (os.path.join (self.directory, name))
+			totalSize -= size
+			
 if __name__ == "__main__":
 	pass
\ No newline at end of file
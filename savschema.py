@@ -104,18 +104,6 @@ def findYesCode (savVariable):
 	for code, value in savVariable.dataset.labelLists [savVariable.labelList].labels.items ():
 		if value == yesLabel: return code
 	
-# See if two answer lists are identical
-def isSameAnswerList (savVariable1, savVariable2):
-	if savVariable1.labelList is None or\
-	   savVariable2.labelList is None or\
-	   len (savVariable1.dataset.labelLists [savVariable1.labelList].labels) !=\
-	   	len (savVariable2.dataset.labelLists [savVariable2.labelList].labels):
-		return False
-	for key, value in savVariable1.dataset.labelLists [savVariable1.labelList].labels.items ():
-		if not savVariable1.dataset.labelLists [savVariable1.labelList].labels.has_key (key): return False
-		if value != savVariable1.dataset.labelLists [savVariable2.labelList].labels [key]: return False
-	return True
-
 def getPrefix (text):
 	if prefixDelimiterText == "": return ""
 	fragments = text.split (prefixDelimiterText)
@@ -131,82 +119,119 @@ def getSuffix (text):
 	else:
 		return ""
 	
-# See if sequence of variables is potentially a multiple based on their names
-def isPotentialMultiple (vList, next):
-	value = (structuredNameIndex (vList [0].name) == 1 or
-		 structuredNameIndex (vList [0].longName) == 1) and\
-	       (structuredNameIndex (next.name) == len (vList) + 1 or
-	        structuredNameIndex (next.longName) == len (vList) + 1) and\
-	        structuredNameRoot (vList [0].name) == structuredNameRoot (next.name)
-	# print "isPotentialMultiple", value, vList [0].name, structuredNameIndex (vList [0].name),\
-	#	next.name, structuredNameIndex (next.name)
-	return value
-# See if sequence of variables looks like a spread format multiple (and not a grid)	
-def isPotentialSpread (vList, next):
-	if vList [0].label.find (spreadMultipleAnswers [0]) >= 0:
-		if len (spreadMultipleAnswers) < len (vList) + 1:
-			raise SavSchemaError, "More spread responses than supplied answers: %s" %\
-				(structuredNameRoot (vList [0].name))
-		value = next.label.find (spreadMultipleAnswers [len (vList)]) >= 0
-	else:
-		value = False
-	# print "isPotentialSpread", value, vList [0], next
-	return value
-def allAnswerListsSingleCategory (vList, next):
-	value = vList [0].length == 1 and next.length == 1
-	# print "allAnswerListsSingleCategory", value, vList [0], next
-	return value
-def allAnswerListsYesNo (vList, next):
-	value = isYesNo (vList [0]) and isYesNo (next)
-	# print "allAnswerListsYesNo", value, vList [0], next
-	return value
-def allAnswerLists01 (vList, next):
-	value = is01 (vList [0]) and is01 (next)
-	# print "allAnswerLists01", value, vList [0], next
-	return value
-def allAnswerListsSame (vList, next):
-	value = isSameAnswerList (vList [0], next)
-	# print "allAnswerListsSame", value, vList [0], next
-	return value
-def commonPrefix (vList, next):
-	lastPrefix = getPrefix (next.label)
-	if len (lastPrefix) == 0: return False
-	for savVariable in vList:
-		thisPrefix = getPrefix (savVariable.label)
-		if thisPrefix != lastPrefix:
-			value = False
-	else:
-		value = True
-	# print "commonPrefix", value, vList [0], next
-	return value			
-def commonSuffix (vList, next):
-	lastSuffix = getSuffix (next.label)
-	if len (lastSuffix) == 0: return False
-	for savVariable in vList:
-		thisSuffix = getSuffix (savVariable.label)
-		if thisSuffix != lastSuffix:
-			value = False
-	else:
-		value = True
-	# print "commonSuffix", value, vList [0], next
-	return value
-
-def isSPSSBitstringMultiple (vList, next):
-	return isPotentialMultiple (vList, next) and\
-	   (allAnswerListsSingleCategory (vList, next) or
-	    allAnswerListsYesNo (vList, next) or
-	    allAnswerLists01 (vList, next)) and\
-	   (commonPrefix (vList, next) or commonSuffix (vList, next))
-
-def isSPSSSpreadMultiple (vList, next):
-	return isPotentialMultiple (vList, next) and\
-	       allAnswerListsSame (vList, next) and\
-	       isPotentialSpread (vList, next)
+# SPSS-style multiples are runs of variables grouped by fprog.group, which
+# offers each variable in turn to the run being built. Every test looks only
+# at the run's first variable, the run's length and the candidate, so the
+# name indices and roots, label prefixes and suffixes and answer list
+# properties of each variable are worked out once, up front, and the sweep
+# is linear in the number of variables.
+#
+# A run has a common prefix (suffix) when its latest variable's label has
+# one; earlier labels have never been compared.
+
+class MultipleFeatures:
+	def __init__ (self, savVariable):
+		self.label = savVariable.label or ""
+		self.indices = (structuredNameIndex (savVariable.name),
+			structuredNameIndex (savVariable.longName))
+		if variableDelimiterText:
+			self.nameRoot = structuredNameRoot (savVariable.name)
+		else:
+			self.nameRoot = None
+		self.hasPrefix = len (getPrefix (self.label)) > 0
+		self.hasSuffix = len (getSuffix (self.label)) > 0
+		self.isSingleCategory = getattr (savVariable, "length", 0) == 1
+		self.isYesNo = isYesNo (savVariable)
+		self.is01 = is01 (savVariable)
+		if savVariable.labelList is None:
+			self.fingerprint = None
+		else:
+			self.fingerprint =\
+				savVariable.dataset.labelLists [savVariable.labelList].fingerprint
+		self.isFirstSpread = self.label.find (spreadMultipleAnswers [0]) >= 0
+		
+class MultipleDetector:
+	def __init__ (self, savVariables):
+		self.features = dict (((id (savVariable), MultipleFeatures (savVariable))
+			for savVariable in savVariables))
+			
+	def group (self, savVariables):
+		return fprog.group (self.isMultiple, savVariables)
 		
-def isSPSSMultiple (vList, next):
-	# print "isSPSSMultiple", vList [0], next
-	return isSPSSBitstringMultiple (vList, next) or\
-	       isSPSSSpreadMultiple (vList, next)
+	# See if sequence of variables is potentially a multiple based on their names
+	def isPotential (self, first, next, count):
+		return 1 in first.indices and count + 1 in next.indices and\
+			first.nameRoot == next.nameRoot
+			
+	# See if sequence of variables looks like a spread format multiple (and not a grid)
+	def isPotentialSpread (self, first, next, count):
+		if first.isFirstSpread:
+			if len (spreadMultipleAnswers) < count + 1:
+				raise SavSchemaError, "More spread responses than supplied answers: %s" %\
+					(first.nameRoot)
+			return next.label.find (spreadMultipleAnswers [count]) >= 0
+		return False
+		
+	def getMotivation (self, vList, next):
+		first = self.features [id (vList [0])]
+		next = self.features [id (next)]
+		if first.isSingleCategory and next.isSingleCategory:
+			return "all single category"
+		elif first.isYesNo and next.isYesNo:
+			return "all yes/no"
+		elif first.is01 and next.is01:
+			return "all coded 0/1"
+		
+	def hasCommonPrefix (self, next):
+		return self.features [id (next)].hasPrefix
+		
+	def hasCommonSuffix (self, next):
+		return self.features [id (next)].hasSuffix
+		
+	def isBitstringMultiple (self, vList, next):
+		first = self.features [id (vList [0])]
+		features = self.features [id (next)]
+		return self.isPotential (first, features, len (vList)) and\
+			self.getMotivation (vList, next) is not None and\
+			(features.hasPrefix or features.hasSuffix)
+			
+	def isSpreadMultiple (self, vList, next):
+		first = self.features [id (vList [0])]
+		features = self.features [id (next)]
+		return self.isPotential (first, features, len (vList)) and\
+			first.fingerprint is not None and first.fingerprint == features.fingerprint and\
+			self.isPotentialSpread (first, features, len (vList))
+			
+	def isMultiple (self, vList, next):
+		return self.isBitstringMultiple (vList, next) or\
+			self.isSpreadMultiple (vList, next)
+
+# A quantity's range covers its write format's width and the values found,
+# or the range of values given
+
+def makeQuantity (variable, savVariable, valueRange=None):
+	if valueRange is None:
+		valueRange = savVariable.min, savVariable.max
+	low, high = valueRange
+	variable.type = 'quantity'
+	if savVariable.write_.format_type == savbinary.floatFormatCode:
+		variable.translatable = True
+	variable.dp = savVariable.write_.dp
+	width = min (24, savVariable.write_.width)
+	if variable.dp > 0:
+		#print "..Variable %s has %d decimal place(s)" %\
+		#	(variable.name, variable.dp)
+		width = max (1, width - (variable.dp + 1))
+	if width > 1:
+		variable.min = min (low, -lengthMaxCode (width-1))
+	else:
+		variable.min = min (low, 0)
+	variable.max = max (high, lengthMaxCode (width))
+	absMin = lengthMaxCode (codeLength (abs (variable.min)))
+	if variable.min < 0.0:
+		variable.min = -absMin
+	variable.max = lengthMaxCode (codeLength (variable.max))
+	# print "quantity", variable.name, variable.min, variable.max
 
 class SAVSchema (SchemaRepresentation):
 
@@ -220,6 +245,7 @@ class SAVSchema (SchemaRepresentation):
 		self.schema = Schema()
 		nonDummyCount = 0
 		nonDummyMap = {}
+		sharedAnswerLists = {}
 		for index, savVariable in enumerate (savDataset.variables):
 			if savVariable.isDummy: continue
 			if savVariable.labelList is not None:
@@ -228,11 +254,14 @@ class SAVSchema (SchemaRepresentation):
 			else:
 				savVariable.length = 0
 			savVariable.labels = None
-		revisedVariables = list (fprog.group (isSPSSMultiple, savDataset.variables))
+		savVariables = [savVariable for savVariable in savDataset.variables
+			if not savVariable.isExcluded]
+		detector = MultipleDetector (savVariables)
+		revisedVariables = list (detector.group (savVariables))
 		multipleCount = 0
 		for variableGroup in revisedVariables:
 			initialVariable = variableGroup [0]
-			maybeSpread = len (variableGroup) <> 1 and isSPSSSpreadMultiple\
+			maybeSpread = len (variableGroup) <> 1 and detector.isSpreadMultiple\
 					(variableGroup [:-1], variableGroup [-1])
 			if len (variableGroup) <> 1 and\
 				((not maybeSpread) or initialVariable.sensibleLabelCount () > 1):
@@ -241,22 +270,18 @@ class SAVSchema (SchemaRepresentation):
 				initialVariable.isSpread = maybeSpread
 				if maybeSpread:
 					multipleMotivation = "spread"
-	   			elif allAnswerListsSingleCategory (variableGroup[:-1], variableGroup [0]):
-	   				multipleMotivation = "all single category"
-	    			elif allAnswerListsYesNo (variableGroup[:-1], variableGroup [0]):
-	    				multipleMotivation = "all yes/no"
-	    			elif allAnswerLists01 (variableGroup[:-1], variableGroup [0]):
-	    				multipleMotivation = "all coded 0/1"
-	    			else:
-	    				raise SchemaError, "Internal error: unclear motivation for classification as multiple: %s" %\
-	    					(variableGroup [0].name,)
+				else:
+					multipleMotivation = detector.getMotivation (variableGroup [:-1], variableGroup [0])
+				if multipleMotivation is None:
+					raise SchemaError, "Internal error: unclear motivation for classification as multiple: %s" %\
+						(variableGroup [0].name,)
 				print "..SPSS-style multiple found: %s (%d categories, %s)" %\
 					(structuredNameRoot (variableGroup [0].name), len(variableGroup), multipleMotivation)
-				if commonPrefix (variableGroup [:-1], variableGroup [-1]):
+				if detector.hasCommonPrefix (variableGroup [-1]):
 					prefixLength = len (getPrefix (initialVariable.label))
 				else:
 					prefixLength = 0
-				if commonSuffix (variableGroup [:-1], variableGroup [-1]):
+				if detector.hasCommonSuffix (variableGroup [-1]):
 					suffixLength = len (getPrefix (initialVariable.label))
 				else:
 					suffixLength = 0
@@ -269,8 +294,8 @@ class SAVSchema (SchemaRepresentation):
 					initialVariable.label = initialVariable.label\
 						[:-len (spreadMultipleAnswers[0])]
 				else:
-					initialVariable.isSingleCategory = allAnswerListsSingleCategory\
-						(variableGroup [:-1], variableGroup [-1])
+					initialVariable.isSingleCategory =\
+						detector.getMotivation (variableGroup [:-1], variableGroup [-1]) == "all single category"
 					initialVariable.labels = []
 					for index, componentVariable in enumerate (variableGroup):
 						if initialVariable.isSingleCategory:
@@ -311,17 +336,22 @@ class SAVSchema (SchemaRepresentation):
 				else:
 					name = structuredNameRoot (savVariable.name)
 			if savVariable.labelList is not None:
-				answerList = AnswerList (self.schema, name)
 				labelList = savDataset.labelLists [savVariable.labelList]
-				codes = [key for key in labelList.labels.keys ()]
-				codes.sort ()
+				codes = []
 				if savVariable.sensibleLabelCount () > 1:
-					for code in codes:
+					codes = [code for code in sorted (labelList.labels.keys ())
 						if code >= 0 and\
 							(savVariable.n_missing_values == 0 or\
-							 not savVariable.isValidMissingValue (code)):
-							Answer (answerList).makeNew\
-								(None, code, labelList.labels [code])
+							 not savVariable.isValidMissingValue (code))]
+				# Variables with the same labels and answers share one list
+				answerListKey = (labelList.fingerprint, tuple (codes))
+				answerList = sharedAnswerLists.get (answerListKey)
+				if answerList is None:
+					answerList = AnswerList (self.schema, name)
+					for code in codes:
+						Answer (answerList).makeNew\
+							(None, code, labelList.labels [code])
+					sharedAnswerLists [answerListKey] = answerList
 			elif savVariable.labels is not None:
 				answerList = AnswerList (self.schema, name)
 				for index, label in enumerate (savVariable.labels):
@@ -377,25 +407,7 @@ class SAVSchema (SchemaRepresentation):
 				variable.type = 'character'
 				variable.length = 19
 			else:
-				variable.type = 'quantity'
-				if savVariable.write_.format_type == savbinary.floatFormatCode:
-					variable.translatable = True
-				variable.dp = savVariable.write_.dp
-				width = min (24, savVariable.write_.width)
-				if variable.dp > 0:
-					#print "..Variable %s has %d decimal place(s)" %\
-					#	(variable.name, variable.dp)
-					width = max (1, width - (variable.dp + 1))
-				if width > 1:
-					variable.min = min (savVariable.min, -lengthMaxCode (width-1))
-				else:
-					variable.min = min (savVariable.min, 0)
-				variable.max = max (savVariable.max, lengthMaxCode (width))
-				absMin = lengthMaxCode (codeLength (abs (variable.min)))
-				if variable.min < 0.0:
-					variable.min = -absMin
-				variable.max = lengthMaxCode (codeLength (variable.max))
-				# print "quantity", variable.name, variable.min, variable.max
+				makeQuantity (variable, savVariable)
 			
 			# print variable.name, savVariable.min, savVariable.max
 			# self.schema.weightVariableSequence = variable.index
@@ -439,9 +451,12 @@ class SAVMultipleVariableValue (SAVVariableValue):
 	
 class SAVDataset (Dataset):
 
-	def __init__ (self, schemaRepresentation, savDataset):
+	def __init__ (self, schemaRepresentation, savDataset, start=0, stop=None, checker=None):
 		Dataset.__init__ (self, schemaRepresentation, savDataset, True)
 		self.savStream = None
+		self.start = start
+		self.stop = stop
+		self.checker = checker
 
 	def _assignVariableValue (self, index):
 		variable = self.schema.variableSequence[index]
@@ -458,6 +473,8 @@ class SAVDataset (Dataset):
 	def read (self):
 		try:
 			self.record = self.savStream.next ()
+			if self.checker is not None:
+				self.checker.check (self.record, self.recordNumber + 1)
 			Dataset.read (self)
 			return True
 		except StopIteration, e:
@@ -465,31 +482,557 @@ class SAVDataset (Dataset):
 		
 	def reset2 (self):
 		Dataset.reset2 (self)
-		self.savStream = self.dataStore.getCaseStream ()
+		self.recordNumber = self.start
+		self.savStream = self.dataStore.getCaseStream ("ignore", self.start, self.stop)
 		
 	def close (self):
 		pass
 
+# Schema templates: the schema inferred from one wave of a survey, laid out
+# for Triple-S, is saved so that later waves with the same dictionary (and
+# inference options) skip multiple detection and sizing, and keep the same
+# column positions. Their values are checked against the template as they
+# are converted. One that doesn't fit stops the conversion or, if widening
+# is allowed, widens the template, which is saved again once the pass is
+# over so the data can be converted again with the new layout.
+
+templateVersion = 1
+inferenceAttributes = ("isDummy", "isMultiple", "isSpread", "count", "length",
+	"yesCode", "isSingleCategory", "labels", "labelList", "label")
+
+def getInferenceOptions (savDataset):
+	return (yesLabel, noLabel, suffixDelimiterText, prefixDelimiterText,
+		tuple (spreadMultipleAnswers), variableDelimiterText, tuple (variableSuffices),
+		savDataset.sensibleStringLengths)
+
+def saveSchemaTemplate (filename, fingerprint, savSchema, sssSchema):
+	import os
+	import cPickle
+	import tempfile
+	variableStates = [dict (((name, savVariable.__dict__ [name])
+		for name in inferenceAttributes if savVariable.__dict__.has_key (name)))
+			for savVariable in savSchema.savDataset.variables]
+	templateFile = tempfile.NamedTemporaryFile (dir=os.path.dirname (os.path.abspath (filename)),
+		delete=False)
+	try:
+		cPickle.dump ((templateVersion, fingerprint, getInferenceOptions (savSchema.savDataset),
+			variableStates, sssSchema), templateFile, 2)
+	finally:
+		templateFile.close ()
+	if os.path.exists (filename):
+		os.remove (filename)
+	os.rename (templateFile.name, filename)
 	
-if __name__ == "__main__":
+# Returns the SAV and Triple-S schemas for the dataset, or None if the
+# template doesn't suit it
+	
+def applySchemaTemplate (filename, fingerprint, savDataset):
+	import cPickle
+	templateFile = open (filename, "rb")
+	try:
+		version, templateFingerprint, options, variableStates, sssSchema = cPickle.load (templateFile)
+	finally:
+		templateFile.close ()
+	if version != templateVersion or templateFingerprint != fingerprint or\
+		options != getInferenceOptions (savDataset):
+		return None
+	for savVariable, variableState in zip (savDataset.variables, variableStates):
+		savVariable.__dict__.update (variableState)
+	savSchema = SAVSchema ()
+	savSchema.savDataset = savDataset
+	savSchema.schema = sssSchema.schema
+	return savSchema, sssSchema
+	
+# Values are measured as the Triple-S writer will output them: one that
+# isn't text (a date that couldn't be converted, say) is written as its
+# string representation
+
+def textLength (value):
+	if isinstance (value, basestring):
+		return len (value)
+	return len (unicode (value))
+	
+class TemplateChecker:
+
+	def __init__ (self, savSchema, sssSchema, widen=False):
+		self.widen = widen
+		self.widened = set ()
+		self.savVariables = [savVariable for savVariable in savSchema.savDataset.variables
+			if not savVariable.isDummy]
+		self.checks = [(index, variable)
+			for index, variable in enumerate (sssSchema.schema.variableSequence)
+				if variable.type in ('character', 'quantity', 'single') or\
+					(variable.type == 'multiple' and variable.isSpread)]
+		self.codes = dict (((index, set ((answer.code for answer in variable.answerList.answers ())))
+			for index, variable in self.checks if variable.type == 'single'))
+				
+	def check (self, record, recordNumber):
+		for index, variable in self.checks:
+			value = record [index] [1]
+			if value is not None and not self.fits (index, variable, value):
+				self.overflow (index, variable, value, recordNumber)
+				
+	def fits (self, index, variable, value):
+		if variable.type == 'character':
+			return textLength (value) <= variable.length
+		elif variable.type == 'quantity':
+			return variable.min <= value <= variable.max
+		elif variable.type == 'single':
+			return value in self.codes [index]
+		return not value or (min (value) >= 0 and codeLength (max (value)) <= variable.width)
+				
+	# Once the schema has been widened, the data is converted again with the
+	# same checks, now only as a safeguard
+	
+	def stopWidening (self):
+		self.widen = False
+		self.widened = set ()
+		
+	def report (self):
+		return "Template widened for %d variable(s)" % len (self.widened)
+		
+	# A single with a code missing from its answer list is widened by making
+	# it a quantity
+	
+	def makeQuantity (self, index, variable, value):
+		makeQuantity (variable, self.savVariables [index], (value, value))
+		
+	def overflow (self, index, variable, value, recordNumber):
+		import math
+		if not self.widen or variable.type == 'multiple':
+			raise SavSchemaError, "Value %s of variable %s at record %d doesn't fit the template" %\
+				(forceEncoding (value), forceEncoding (variable.name), recordNumber)
+		self.widened.add (variable.name)
+		if variable.type == 'single':
+			self.makeQuantity (index, variable, value)
+			if self.fits (index, variable, value): return
+		if variable.type == 'character':
+			while variable.length < textLength (value):
+				variable.length *= 2
+		elif value > variable.max:
+			variable.max = lengthMaxCode (codeLength (int (math.ceil (value))))
+		else:
+			variable.min = -lengthMaxCode (codeLength (int (math.ceil (-value))))
+		
+# Widths sized from a sample of the cases are checked in the same way, and
+# always widened, but only where the sample could make a difference: the
+# lengths of long strings, the ranges of quantities and the codes of
+# singles. A labelled variable taken as single that turns out to have an
+# unlabelled value becomes a quantity, as a full sizing pass would have
+# made it.
+
+class SampleChecker (TemplateChecker):
+
+	def __init__ (self, savSchema, sssSchema):
+		TemplateChecker.__init__ (self, savSchema, sssSchema, True)
+		self.overflowCount = 0
+		self.checks = [(index, variable) for index, variable in self.checks
+			if variable.type in ('quantity', 'single') or (variable.type == 'character' and\
+				self.isSampledLength (self.savVariables [index]))]
+		
+	def isSampledLength (self, savVariable):
+		return savVariable.type_ > 0 and savVariable.dataset.sensibleStringLengths and\
+			(savVariable.extendedStringLength or savVariable.type_ == 255)
+		
+	def makeQuantity (self, index, variable, value):
+		makeQuantity (variable, self.savVariables [index])
+		
+	def report (self):
+		return "%d value(s) of %d variable(s) didn't fit the widths sized from a sample" %\
+			(self.overflowCount, len (self.widened))
+			
+	def overflow (self, index, variable, value, recordNumber):
+		self.overflowCount += 1
+		TemplateChecker.overflow (self, index, variable, value, recordNumber)
+		
+# Parallel conversion: the cases are cut into ranges at sync points, each
+# range is converted to its own data file by a worker process, and the
+# range files are then appended to the output in case order
+
+shardState = None
+
+def initShardWorker (state):
+	global shardState
+	shardState = state
+	state [0].savDataset.resetProcessState ()
+	
+def convertShard (shard):
+	import sssxmlschema
+	savSchema, newSchema, dataEncoding, format, multipleDelimiter = shardState
+	start, stop, filename = shard
+	SSSDataset = sssxmlschema.SSSDataset (newSchema, filename, False, dataEncoding,
+		format, multipleDelimiter, header=False)
+	savDataset = SAVDataset (savSchema, savSchema.savDataset, start, stop)
+	savDataset.convert (SSSDataset)
+	SSSDataset.close ()
+	return savDataset.recordNumber - start
+	
+def convertInParallel (savSchema, newSchema, filename, dataEncoding, format,
+	multipleDelimiter, processCount, shardCount=None):
+	import multiprocessing
+	import shutil
+	import os
+	import sssxmlschema
+	if shardCount is None:
+		shardCount = 4 * processCount
+	caseRanges = savSchema.savDataset.getCaseRanges (shardCount)
+	print "..Converting %d case range(s) on %d process(es)" % (len (caseRanges), processCount)
+	shards = [(start, stop, "%s.%d.part" % (filename, index))
+		for index, (start, stop) in enumerate (caseRanges)]
+	pool = multiprocessing.Pool (processCount, initShardWorker,
+		((savSchema, newSchema, dataEncoding, format, multipleDelimiter),))
+	try:
+		caseCounts = pool.map (convertShard, shards)
+		pool.close ()
+		SSSDataset = sssxmlschema.SSSDataset (newSchema, filename, False, dataEncoding,
+			format, multipleDelimiter)
+		for start, stop, shardFilename in shards:
+			shardFile = open (shardFilename)
+			shutil.copyfileobj (shardFile, SSSDataset.dataStore)
+			shardFile.close ()
+		SSSDataset.close ()
+	finally:
+		pool.terminate ()
+		pool.join ()
+		for start, stop, shardFilename in shards:
+			if os.path.exists (shardFilename):
+				os.remove (shardFilename)
+	return sum (caseCounts)
+
+	
+# Command line conversion. The settings read from the switches are held in
+# an options dictionary; configure () copies the ones that govern inference
+# into module globals, so worker processes converting a batch of files see
+# the same settings as the parent.
+
+def logExceptionText (details=None):
+	import sys
+	import traceback
+	if details is None:
+		details = sys.exc_info()
+	(type, value, tb) = details
+	return """Exception:	 %s
+	Description: %s
+	Traceback:	 %s""" %\
+		(type, value, traceback.extract_tb (tb))
+		
+def logException (details=None):
 	import sys
+	print >>sys.stderr, logExceptionText (details)
+	
+def configure (options):
+	global yesLabel, noLabel, suffixDelimiterText, prefixDelimiterText
+	global spreadMultipleAnswers, variableDelimiterText, variableSuffices
+	yesLabel = options ["yesLabel"]
+	noLabel = options ["noLabel"]
+	suffixDelimiterText = options ["suffixDelimiterText"]
+	prefixDelimiterText = options ["prefixDelimiterText"]
+	spreadMultipleAnswers = options ["spreadMultipleAnswers"]
+	variableDelimiterText = options ["variableDelimiterText"]
+	variableSuffices = options ["variableSuffices"]
+	
+# The variables to convert: comma-separated names or wildcard patterns, and
+# @file for a file of them, one per line
+
+def readVariableSelection (text, encoding):
+	patterns = []
+	for item in text.split (","):
+		item = item.strip ()
+		if item.startswith ("@"):
+			listFile = open (item [1:])
+			patterns.extend ([line.strip ().decode (encoding) for line in listFile
+				if line.strip () and not line.startswith ("#")])
+			listFile.close ()
+		elif item:
+			patterns.append (item.decode (encoding))
+	return tuple (patterns)
+	
+def getCaseSelection (limit, every, fraction, seed=0):
+	if limit is None and every is None and fraction is None:
+		return None
+	if limit is not None and limit < 1:
+		raise SavSchemaError, "Usage: -L needs a number of cases of at least 1, e.g. -L1000"
+	if every is not None and every < 1:
+		raise SavSchemaError, "Usage: -E needs a number of at least 1, e.g. -E10"
+	if fraction is not None and not 0 < fraction <= 1:
+		raise SavSchemaError, "Usage: -R needs a fraction above 0 and at most 1, e.g. -R0.05"
+	return savbinary.CaseSelection (limit, every, fraction, seed)
+	
+def convertSAVFile (filename, options, source=None):
 	import os.path
-	import getopt
-	import sssxmlschema
 	import datetime
-			
-	def logExceptionText (details=None):
-		import traceback
-		if details is None:
-			details = sys.exc_info()
-		(type, value, tb) = details
-		return """Exception:	 %s
-		Description: %s
-		Traceback:	 %s""" %\
-			(type, value, traceback.extract_tb (tb))
+	import sssxmlschema
+	if options ["csv"]:
+		format = 'csv'
+		extension = '.csv'
+	else:
+		format = 'asc'
+		extension = '.asc'
+	root = getOutputRoot (filename)
+	print "..Converting %s to %s.xml and %s%s" %\
+		(filename, root, root, extension)
+	href = options ["href"]
+	if not href:
+		href = "%s%s" % (root, extension)
+	if href.strip ():
+		print "..href attribute will be '%s'" % href
+	outputEncoding = options ["outputEncoding"]
+	full = options ["full"]
+	schemaOnly = options ["schemaOnly"]
+	templateFilename = options ["templateFilename"]
+	haveTemplate = templateFilename is not None and os.path.exists (templateFilename)
+	if options ["caseSelection"] is not None:
+		print "..Cases selected: %s" % options ["caseSelection"]
+	
+	try:
+		if options ["cacheDirectory"]:
+			cache = savbinary.MetadataCache (options ["cacheDirectory"])
+		else:
+			cache = None
+		savData = savbinary.SAVDataset (source or filename, options ["sensibleStringLengths"],
+			spool=options ["spool"], cache=cache, lazy=haveTemplate or schemaOnly,
+			sampleSize=options ["sampleSize"], selection=options ["selection"],
+			caseSelection=options ["caseSelection"])
+	except exceptions.Exception, e:
+		print "Can't load SAV file (%s)" % e
+		logException ()
+		raise
+	try:
+		schemas = None
+		if templateFilename is not None:
+			fingerprint = savData.getDictionaryFingerprint ()
+		if haveTemplate:
+			schemas = applySchemaTemplate (templateFilename, fingerprint, savData)
+			if schemas is None:
+				print "..Template %s doesn't match %s, it will be replaced" %\
+					(templateFilename, filename)
+		if schemas is not None:
+			savSchema, newSchema = schemas
+			newSchema.href = href
+			checker = TemplateChecker (savSchema, newSchema, options ["widenTemplate"])
+			print "..SAV file %s loaded with template %s, %d variable(s)" %\
+				(filename, templateFilename, len (savSchema.schema.variableSequence))
+		else:
+			if schemaOnly:
+				savData.sizeFromDictionary ()
+			savSchema = SAVSchema ()
+			savSchema.load (savData)
+			newSchema = sssxmlschema.SSSXMLSchema().convert (savSchema.schema, href)
+			if savData.sizedFromSample:
+				checker = SampleChecker (savSchema, newSchema)
+			else:
+				checker = None
+			print "..SAV file %s loaded, %d variable(s), %d answer list(s)" %\
+				(filename,
+				 len(savSchema.schema.variableSequence),
+				 len(savSchema.schema.answerListMap))
+		if savData.n_lines:
+			documentFile = open (root + ".txt", 'w')
+			for i in xrange (savData.n_lines):
+				print >>documentFile, forceEncoding (savData.lines [i], outputEncoding).strip ()
+			documentFile.close ()
+			print "..%d line(s) for documentation written to %s.txt" %\
+				(savData.n_lines, root) 
+		if full: savData.printMetadata (True)
+		sssDate = options ["sssDate"]
+		sssTime = options ["sssTime"]
+		if not sssDate.strip () and savData.creation_date:
+			sssDate = savData.creation_date
+		if not sssTime.strip () and savData.creation_time:
+			sssTime = savData.creation_time
+		if sssDate and sssDate.lower () == 'now':
+			sssDate = str(datetime.date.today ())
+		if sssTime and sssTime.lower () == 'now':
+			sssTime = str(datetime.datetime.now ().time ()) [:5]
+		newSchema.sssDate = sssDate
+		newSchema.sssTime = sssTime
+		newSchema.sssOrigin = options ["sssOrigin"]
+		newSchema.sssUser = options ["sssUser"]
+		newSchema.ident = options ["ident"]
+		newSchema.schema.name = options ["name"]
+		newSchema.schema.title = options ["title"]
+		newSchema.allocate()
+		outputXMLFile = open (root + ".xml", 'w')
+		newSchema.save (outputXMLFile, format=format)
+		outputXMLFile.close ()
+		if templateFilename is not None and schemas is None:
+			saveSchemaTemplate (templateFilename, fingerprint, savSchema, newSchema)
+			print "..Template saved to %s" % templateFilename
+		if schemaOnly:
+			print "..Schema only, data not converted"
+			return savData.ncases
+		if options ["processCount"] > 1 and not full and savData.source is None and\
+			checker is None and savData.caseSelection is None:
+			SSSDataset = None
+			caseCount = convertInParallel (savSchema, newSchema, root + extension,
+				outputEncoding, format, options ["multipleDelimiter"], options ["processCount"])
+		else:
+			while True:
+				SSSDataset = sssxmlschema.SSSDataset (newSchema, root + extension, False, outputEncoding,
+					format, options ["multipleDelimiter"])
+				savDataset = SAVDataset (savSchema, savData, checker=checker)
+				savDataset.convert (SSSDataset)
+				caseCount = savDataset.recordNumber
+				if checker is None: break
+				if not checker.widened:
+					if isinstance (checker, SampleChecker) and checker.widen:
+						print "..Widths sized from a sample of %d case(s) fit all %d case(s)" %\
+							(savData.sampledCaseCount, caseCount)
+					break
+				SSSDataset.close ()
+				print "..%s, converting again" % checker.report ()
+				newSchema.allocate ()
+				outputXMLFile = open (root + ".xml", 'w')
+				newSchema.save (outputXMLFile, format=format)
+				outputXMLFile.close ()
+				if templateFilename is not None:
+					saveSchemaTemplate (templateFilename, fingerprint, savSchema, newSchema)
+				checker.stopWidening ()
+		print "..%d case(s) recovered from proprietary format" % caseCount
+		if full and format == 'asc':
+			distributions = SSSDataset.getDistributions ()
+			for vv, distribution in distributions:
+				itemCount = len (distribution)
+				others = 0
+			 	print "Variable\t%s Distribution" %\
+			 		forceEncoding (vv.variable.name)
+				for value, total in distribution.items ():
+					if itemCount < 10 or total.unweightedTotal >  1:
+						print "Value\t%s\t%s" % (value, total.unweightedTotal)
+					else:
+						others += 1
+				if others > 0:
+					print "Unlisted singleton values:", others						
+		if SSSDataset is not None:
+			SSSDataset.close ()
+		outputXMLFile.close ()
+		return caseCount
+		
+	except exceptions.Exception, e:
+		print "Cannot prepare triple-S XML dataset (%s)" % e
+		logException ()
+		raise
+	finally:
+		savData.close ()
 		
-	def logException (details=None):
-		print >>sys.stderr, logExceptionText (details)
+# Batch conversion: the files named by directories (every .sav and .zsav
+# file in them), glob patterns and manifests (@file, one name per line) are
+# converted by a pool of worker processes, one file per task. A failure
+# only affects its own file and is recorded in the summary.
+
+savFileExtensions = (".sav", ".zsav")
+
+def isSAVFilename (filename):
+	import os
+	(root, extension) = os.path.splitext (filename.lower ())
+	if extension in savbinary.wrapperExtensions:
+		extension = os.path.splitext (root) [1]
+	return extension in savFileExtensions
+
+def getOutputRoot (filename):
+	import os.path
+	(root, extension) = os.path.splitext (filename)
+	if extension.lower () in savbinary.wrapperExtensions and\
+		os.path.splitext (root) [1].lower () in savFileExtensions:
+		root = os.path.splitext (root) [0]
+	return root
+	
+def findSAVFiles (names):
+	import os
+	import glob
+	filenames = []
+	for name in names:
+		if name.startswith ("@"):
+			manifest = open (name [1:])
+			filenames.extend (findSAVFiles ([line.strip () for line in manifest
+				if line.strip () and not line.startswith ("#")]))
+			manifest.close ()
+		elif os.path.isdir (name):
+			filenames.extend (sorted ([os.path.join (name, entry) for entry in os.listdir (name)
+				if isSAVFilename (entry)]))
+		elif glob.has_magic (name):
+			filenames.extend (sorted (glob.glob (name)))
+		else:
+			filenames.append (name)
+	return filenames
+	
+def convertBatchFile (filename):
+	import time
+	startTime = time.time ()
+	try:
+		caseCount = convertSAVFile (filename, batchOptions)
+	except exceptions.Exception, e:
+		return filename, False, None, time.time () - startTime, str (e)
+	return filename, True, caseCount, time.time () - startTime, ""
+	
+batchOptions = None
+
+# Files that would write the same output (t.sav, t.zsav and t.sav.gz all
+# write t.xml and t.asc) fail together rather than overwrite each other
+
+def findOutputClashes (filenames):
+	import os.path
+	owners = {}
+	for filename in filenames:
+		key = os.path.normcase (os.path.abspath (getOutputRoot (filename)))
+		owners.setdefault (key, []).append (filename)
+	clashes = {}
+	for sharing in owners.values ():
+		if len (sharing) > 1:
+			for filename in sharing:
+				clashes [filename] = "%s.xml would be written for each of %s" %\
+					(getOutputRoot (filename), ", ".join (sharing))
+	return clashes
+
+def initBatchWorker (options):
+	global batchOptions
+	batchOptions = options
+	configure (options)
+	
+def convertBatch (filenames, options, workerCount, summaryFilename=None):
+	import multiprocessing
+	import time
+	from sssxmlschema import escapedCSVText
+	startTime = time.time ()
+	options = dict (options, processCount=1)	# pool workers can't start pools of their own
+	clashes = findOutputClashes (filenames)
+	pool = multiprocessing.Pool (workerCount, initBatchWorker, (options,))
+	try:
+		converted = pool.map (convertBatchFile,
+			[filename for filename in filenames if filename not in clashes], 1)
+		pool.close ()
+	finally:
+		pool.terminate ()
+		pool.join ()
+	converted.reverse ()
+	results = []
+	for filename in filenames:
+		if filename in clashes:
+			results.append ((filename, False, None, 0.0, clashes [filename]))
+		else:
+			results.append (converted.pop ())
+	failures = [result for result in results if not result [1]]
+	print "..Batch of %d file(s) converted in %.1fs, %d failure(s)" %\
+		(len (results), time.time () - startTime, len (failures))
+	for filename, succeeded, caseCount, seconds, errorText in results:
+		if succeeded:
+			print "..%s: %d case(s), %.1fs" % (filename, caseCount, seconds)
+		else:
+			print "--%s: failed after %.1fs (%s)" % (filename, seconds, errorText)
+	if summaryFilename:
+		summaryFile = open (summaryFilename, 'w')
+		print >>summaryFile, "file,status,cases,seconds,error"
+		for filename, succeeded, caseCount, seconds, errorText in results:
+			print >>summaryFile, ",".join ((escapedCSVText (filename),
+				("failed", "converted") [succeeded], savbinary.blankNone (caseCount),
+				"%.3f" % seconds, escapedCSVText (errorText)))
+		summaryFile.close ()
+	return results
+	
+if __name__ == "__main__":
+	import sys
+	import getopt
+	import multiprocessing
 	
 	if len(sys.argv) < 2:
 		print "--Usage: savschema [options] SAV-file-name"
@@ -515,8 +1058,23 @@ if __name__ == "__main__":
 	multipleDelimiter = ""
 	variableDelimiterText = u""
 	variableSuffices = []
+	spool = False
+	processCount = 1
+	cacheDirectory = None
+	workerCount = 0
+	summaryFilename = None
+	templateFilename = None
+	widenTemplate = False
+	sampleSize = None
+	schemaOnly = False
+	selectionText = None
+	caseLimit = None
+	caseInterval = None
+	caseFraction = None
+	caseSeed = 0
 	
-	optlist, args = getopt.getopt(sys.argv[1:], 'cvsfo:i:y:n:a:b:m:x:h:t:d:e:')
+	multiprocessing.freeze_support ()
+	optlist, args = getopt.getopt(sys.argv[1:], 'cvsfpGMo:i:y:n:a:b:m:x:h:t:d:e:j:C:w:S:T:k:V:L:E:R:')
 	for (option, value) in optlist:
 		if option == '-c':
 			csv = True
@@ -526,6 +1084,35 @@ if __name__ == "__main__":
 			sensibleStringLengths = False
 		if option == '-f':
 			full = True
+		if option == '-p':
+			spool = True
+		if option == '-j':
+			processCount = int (value)
+		if option == '-C':
+			cacheDirectory = value
+		if option == '-w':
+			workerCount = int (value)
+		if option == '-S':
+			summaryFilename = value
+		if option == '-T':
+			templateFilename = value
+		if option == '-G':
+			widenTemplate = True
+		if option == '-k':
+			sampleSize = int (value)
+		if option == '-M':
+			schemaOnly = True
+		if option == '-V':
+			selectionText = value
+		if option == '-L':
+			caseLimit = int (value)
+		if option == '-E':
+			caseInterval = int (value)
+		if option == '-R':
+			fractionSeed = value.split (":")
+			caseFraction = float (fractionSeed [0])
+			if len (fractionSeed) > 1:
+				caseSeed = int (fractionSeed [1])
 		if option == '-o':
 			outputEncoding = value
 		if option == '-i':
@@ -555,6 +1142,12 @@ if __name__ == "__main__":
 				variableDelimiterText = variableDelimiterText [0]
 				print "..Variable delimiter will be '%s'" % variableDelimiterText
 
+	if selectionText is None:
+		selection = None
+	else:
+		selection = readVariableSelection (selectionText, outputEncoding)
+	caseSelection = getCaseSelection (caseLimit, caseInterval, caseFraction, caseSeed)
+		
 	nameTitle = titleText.split (";")
 	if len (nameTitle) == 1:
 		name = ""
@@ -593,87 +1186,57 @@ if __name__ == "__main__":
 				
 	if showVersion:
 		print "..sav2sss version %s" % version
-				
-	if csv:
-		format = 'csv'
-		extension = '.csv'
-	else:
-		format = 'asc'
-		extension = '.asc'
-	(root, savExt) = os.path.splitext (args [0])
-	print "..Converting %s to %s.xml and %s%s" %\
-		(args [0], root, root, extension)
-	if not href:
-		href = "%s%s" % (root, extension)
-	if href.strip ():
-		print "..href attribute will be '%s'" % href
 		
-	if len(args) == 1 and ident.isalpha () and len(ident) == 1:
+	options = {
+		"sensibleStringLengths": sensibleStringLengths,
+		"full": full,
+		"outputEncoding": outputEncoding,
+		"ident": ident,
+		"yesLabel": yesLabel,
+		"noLabel": noLabel,
+		"suffixDelimiterText": suffixDelimiterText,
+		"prefixDelimiterText": prefixDelimiterText,
+		"spreadMultipleAnswers": spreadMultipleAnswers,
+		"variableDelimiterText": variableDelimiterText,
+		"variableSuffices": variableSuffices,
+		"sssUser": sssUser,
+		"sssDate": sssDate,
+		"sssTime": sssTime,
+		"sssOrigin": sssOrigin,
+		"href": href,
+		"name": name,
+		"title": title,
+		"csv": csv,
+		"multipleDelimiter": multipleDelimiter,
+		"spool": spool,
+		"processCount": processCount,
+		"cacheDirectory": cacheDirectory,
+		"templateFilename": templateFilename,
+		"widenTemplate": widenTemplate,
+		"sampleSize": sampleSize,
+		"schemaOnly": schemaOnly,
+		"selection": selection,
+		"caseSelection": caseSelection}
+	configure (options)
+	
+	if workerCount > 0:
+		filenames = findSAVFiles (args)
+		if filenames:
+			convertBatch (filenames, options, workerCount, summaryFilename)
+		else:
+			print "--No SAV files found in %s" % " ".join (args)
+	elif len(args) == 1 and ident.isalpha () and len(ident) == 1:
 		try:
-			savData = savbinary.SAVDataset (args [0], sensibleStringLengths)
+			convertSAVFile (args [0], options)
 		except exceptions.Exception, e:
-			print "Can't load SAV file (%s)" % e
-			logException ()
-		else:
-			try:
-				savSchema = SAVSchema ()
-				savSchema.load (savData)
-				print "..SAV file %s loaded, %d variable(s), %d answer list(s)" %\
-					(args[0],
-					 len(savSchema.schema.variableSequence),
-					 len(savSchema.schema.answerListMap))
-				if savData.n_lines:
-					documentFile = open (root + ".txt", 'w')
-					for i in xrange (savData.n_lines):
-						print >>documentFile, forceEncoding (savData.lines [i], outputEncoding).strip ()
-					documentFile.close ()
-					print "..%d line(s) for documentation written to %s.txt" %\
-						(savData.n_lines, root) 
-				if full: savData.printMetadata (True)
-				newSchema = sssxmlschema.SSSXMLSchema().convert (savSchema.schema, href)
-				if not sssDate.strip () and savData.creation_date:
-					sssDate = savData.creation_date
-				if not sssTime.strip () and savData.creation_time:
-					sssTime = savData.creation_time
-				if sssDate and sssDate.lower () == 'now':
-					sssDate = str(datetime.date.today ())
-				if sssTime and sssTime.lower () == 'now':
-					sssTime = str(datetime.datetime.now ().time ()) [:5]
-				newSchema.sssDate = sssDate
-				newSchema.sssTime = sssTime
-				newSchema.sssOrigin = sssOrigin
-				newSchema.sssUser = sssUser
-				newSchema.ident = ident
-				newSchema.schema.name = name
-				newSchema.schema.title = title
-				newSchema.allocate()
-				outputXMLFile = open (root + ".xml", 'w')
-				newSchema.save (outputXMLFile, format=format)
-				outputXMLFile.close ()
-				SSSDataset = sssxmlschema.SSSDataset (newSchema, root + extension, False, outputEncoding,
-					format, multipleDelimiter)
-				savDataset = SAVDataset (savSchema, savData)
-				savDataset.convert (SSSDataset)
-				print "..%d case(s) recovered from proprietary format" % savDataset.recordNumber
-				if full and not csv:
-					distributions = SSSDataset.getDistributions ()
-					for vv, distribution in distributions:
-						itemCount = len (distribution)
-						others = 0
-					 	print "Variable\t%s Distribution" %\
-					 		forceEncoding (vv.variable.name)
-						for value, total in distribution.items ():
-							if itemCount < 10 or total.unweightedTotal >  1:
-								print "Value\t%s\t%s" % (value, total.unweightedTotal)
-							else:
-								others += 1
-						if others > 0:
-							print "Unlisted singleton values:", others						
-				SSSDataset.close ()
-				outputXMLFile.close ()
-				
-			except exceptions.Exception, e:
-				print "Cannot prepare triple-S XML dataset (%s)" % e
-				logException ()
+			pass	# already reported
+	elif len(args) == 2 and args [0] == "-":
+		if sys.platform == "win32":
+			import os, msvcrt
+			msvcrt.setmode (sys.stdin.fileno (), os.O_BINARY)
+		try:
+			convertSAVFile (args [1], options, sys.stdin)
+		except exceptions.Exception, e:
+			pass	# already reported
 	else:
 		print  "--Usage: savschema [-v] [-s] [-f] [-iIdent] [-oOutputEncoding] SAV-file-name"
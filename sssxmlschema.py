@@ -554,7 +554,7 @@ class SSSBitstringVariableValue (SSSMultipleVariableValue):
 class SSSDataset (Dataset):
 
 	def __init__ (self, schemaRepresentation, filename, isInput=True,
-		dataEncoding="ascii", format="asc", multipleDelimiter=""):
+		dataEncoding="ascii", format="asc", multipleDelimiter="", header=True):
 		if isInput:
 			dataFile = file (filename)
 		else:
@@ -567,7 +567,7 @@ class SSSDataset (Dataset):
 		self.multipleDelimiter = multipleDelimiter
 		Dataset.__init__ (self, schemaRepresentation, dataFile, isInput)
 		if self.format == "csv":
-			if isInput:
+			if isInput or not header:
 				pass
 			else:
 				titles = []
@@ -0,0 +1,323 @@
+# Copyright (c) 2014 Computable Functions Limited, UK
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Regression tests for conversion with schema templates, sample sizing,
+# batches and text caching, run with python -m unittest test_savschema.
+# Small SAV files, some of them bytecode compressed, are written for the
+# conversion tests.
+
+import gzip
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import savbinary
+import savschema
+
+SPSSEpochSeconds = 12219379200	# 1582-10-14 to 1970-01-01
+unconvertibleDate = 1e300
+
+def pad (text, length):
+	return (text + " " * length) [:length]
+
+def formatSpec (formatType, width, dp=0):
+	return struct.pack ("<i", dp | (width << 8) | (formatType << 16))
+
+# Bytecode compression: each block of 8 command bytes is followed by the
+# raw values its commands call for; whole numbers from -99 to 151 are coded
+# in the command byte itself
+
+def compressItems (items):
+	data = []
+	for offset in xrange (0, len (items), 8):
+		commands = []
+		raws = []
+		for item in items [offset:offset + 8]:
+			if isinstance (item, float) and -99 <= item <= 151 and item == int (item):
+				commands.append (chr (int (item) + 100))
+			else:
+				commands.append (chr (253))
+				raws.append (item)
+		data.append ("".join (commands) + "\0" * (8 - len (commands)))
+		data.extend ([packItem (raw) for raw in raws])
+	return data
+
+def packItem (item):
+	if isinstance (item, float):
+		return struct.pack ("<d", item)
+	return pad (item, 8)
+
+# Variables are (name, formatType, width, label, values), formatType 1 for
+# strings of up to 8 characters; label lists are (codes, name) pairs
+
+def writeSAVFile (filename, variables, labelLists=(), compressed=False):
+	caseCount = len (variables [0] [4])
+	records = ["$FL2" + pad ("@(#) SPSS DATA FILE test", 60) +
+		struct.pack ("<iiiiid", 2, len (variables), int (compressed), 0, caseCount, 100.0) +
+		"01 Jan 14" + "12:00:00" + pad ("", 64) + "\0\0\0"]
+	for name, formatType, width, label, values in variables:
+		type_ = (0, 8) [formatType == 1]
+		records.append (struct.pack ("<iiii", 2, type_, 1, 0) +
+			formatSpec (formatType, width) * 2 + pad (name, 8) +
+			struct.pack ("<i", len (label)) + pad (label, (len (label) + 3) / 4 * 4))
+	for codes, name in labelLists:
+		record = struct.pack ("<ii", 3, len (codes))
+		for code in codes:
+			text = "Code %d" % code
+			record += struct.pack ("<dB", code, len (text)) + pad (text, (len (text) + 8) / 8 * 8 - 1)
+		position = [variable [0] for variable in variables].index (name) + 1
+		records.append (record + struct.pack ("<iii", 4, 1, position))
+	records.append (struct.pack ("<iiii", 7, 4, 8, 3) +
+		struct.pack ("<ddd", -1.7976931348623157e308, 1.7976931348623157e308, -1.7976931348623155e308))
+	records.append (struct.pack ("<ii", 999, 0))
+	items = [variable [4] [case] for case in xrange (caseCount) for variable in variables]
+	if compressed:
+		records.extend (compressItems (items))
+	else:
+		records.extend ([packItem (item) for item in items])
+	savFile = open (filename, "wb")
+	savFile.write ("".join (records))
+	savFile.close ()
+
+def getOptions (**settings):
+	options = {
+		"sensibleStringLengths": True,
+		"full": False,
+		"outputEncoding": "cp1252",
+		"ident": "A",
+		"yesLabel": "Yes",
+		"noLabel": "No",
+		"suffixDelimiterText": "",
+		"prefixDelimiterText": ":",
+		"spreadMultipleAnswers": [":1st answer", ":2nd answer"],
+		"variableDelimiterText": u"",
+		"variableSuffices": [],
+		"sssUser": "",
+		"sssDate": "",
+		"sssTime": "",
+		"sssOrigin": "",
+		"href": "",
+		"name": "",
+		"title": "",
+		"csv": False,
+		"multipleDelimiter": "",
+		"spool": False,
+		"processCount": 1,
+		"cacheDirectory": None,
+		"templateFilename": None,
+		"widenTemplate": False,
+		"sampleSize": None,
+		"schemaOnly": False,
+		"selection": None,
+		"caseSelection": None}
+	options.update (settings)
+	savschema.configure (options)
+	return options
+
+def dates (caseCount, badCase=None):
+	return [case == badCase and unconvertibleDate or SPSSEpochSeconds + 86400.0 * (10000 + case)
+		for case in xrange (caseCount)]
+
+class ConversionTest (unittest.TestCase):
+
+	def setUp (self):
+		self.directory = tempfile.mkdtemp ()
+
+	def tearDown (self):
+		shutil.rmtree (self.directory)
+
+	def path (self, name):
+		return os.path.join (self.directory, name)
+
+	def read (self, name):
+		dataFile = open (self.path (name))
+		try:
+			return dataFile.read ()
+		finally:
+			dataFile.close ()
+
+	def testTemplateWithUnconvertibleDate (self):
+		writeSAVFile (self.path ("wave.sav"), [
+			("ID", 5, 8, "Id", [float (case + 1) for case in xrange (20)]),
+			("DOB", 20, 11, "Date of birth", dates (20, 5)),
+			("NAME", 1, 8, "Name", ["abc"] * 20)])
+		options = getOptions (templateFilename=self.path ("wave.tpl"))
+		savschema.convertSAVFile (self.path ("wave.sav"), options)
+		firstData = self.read ("wave.asc")
+		self.assertEqual (savschema.convertSAVFile (self.path ("wave.sav"), options), 20)
+		self.assertEqual (self.read ("wave.asc"), firstData)
+
+	def testSchemaOnlyTemplateWithUnlabelledCode (self):
+		variables = [("ID", 5, 8, "Id", [float (case + 1) for case in xrange (20)]),
+			("SAT2", 5, 1, "Satisfaction", [float (case % 5 + 1) for case in xrange (20)])]
+		labelLists = [((1, 2, 3, 4, 5), "SAT2")]
+		writeSAVFile (self.path ("wave1.sav"), variables, labelLists)
+		savschema.convertSAVFile (self.path ("wave1.sav"),
+			getOptions (templateFilename=self.path ("waves.tpl"), schemaOnly=True))
+		variables [1] [4] [7] = 7.0
+		writeSAVFile (self.path ("wave2.sav"), variables, labelLists)
+		self.assertRaises (savschema.SavSchemaError, savschema.convertSAVFile,
+			self.path ("wave2.sav"), getOptions (templateFilename=self.path ("waves.tpl")))
+		savschema.convertSAVFile (self.path ("wave2.sav"),
+			getOptions (templateFilename=self.path ("waves.tpl"), widenTemplate=True))
+		self.assert_ ('<variable ident="2" type="quantity">' in self.read ("wave2.xml"))
+		self.assertEqual (self.read ("wave2.asc").splitlines () [7] [8:], "7")
+
+	def convertWithCommandLine (self, *arguments):
+		command = [sys.executable, os.path.join (os.path.dirname (os.path.abspath (__file__)), "savschema.py")]
+		log = open (self.path ("log.txt"), "w")
+		try:
+			subprocess.check_call (command + list (arguments), cwd=self.directory,
+				stdout=log, stderr=subprocess.STDOUT)
+		finally:
+			log.close ()
+
+	def testCommandLineDefaults (self):
+		writeSAVFile (self.path ("plain.sav"), [
+			("ID", 5, 8, "Id", [float (case + 1) for case in xrange (20)]),
+			("Q_1", 5, 1, "Seen: Brand A", [float (case % 2) for case in xrange (20)]),
+			("Q_2", 5, 1, "Seen: Brand B", [float (case / 10) for case in xrange (20)]),
+			("NAME", 1, 8, "Name", ["abc"] * 20)])
+		for arguments in ((), ("-Tplain.tpl",), ("-Tplain.tpl",)):
+			self.convertWithCommandLine (*(arguments + ("plain.sav",)))
+			self.assert_ ("20 case(s) recovered" in self.read ("log.txt"))
+			self.assertEqual (len (self.read ("plain.asc").splitlines ()), 20)
+
+	def testParallelSpooledConversion (self):
+		variables = [("ID", 5, 8, "Id", [float (case + 1) for case in xrange (3000)]),
+			("AGE", 5, 3, "Age", [float (case * 7 % 90) for case in xrange (3000)]),
+			("WT", 5, 8, "Weight", [case * 0.37 for case in xrange (3000)]),
+			("NAME", 1, 8, "Name", ["n%d" % (case % 40) for case in xrange (3000)])]
+		writeSAVFile (self.path ("serial.sav"), variables, compressed=True)
+		writeSAVFile (self.path ("parallel.sav"), variables, compressed=True)
+		self.assertEqual (savschema.convertSAVFile (self.path ("serial.sav"), getOptions ()), 3000)
+		self.assertEqual (savschema.convertSAVFile (self.path ("parallel.sav"),
+			getOptions (spool=True, processCount=4)), 3000)
+		self.assertEqual (self.read ("parallel.asc"), self.read ("serial.asc"))
+
+	def testWrappedFileReadAgain (self):
+		writeSAVFile (self.path ("wrapped.sav"), [
+			("ID", 5, 8, "Id", [float (case + 1) for case in xrange (50)]),
+			("NAME", 1, 8, "Name", ["n%d" % (case % 7) for case in xrange (50)])], compressed=True)
+		savFile = open (self.path ("wrapped.sav"), "rb")
+		wrappedFile = gzip.GzipFile (self.path ("wrapped.sav.gz"), "wb")
+		wrappedFile.write (savFile.read ())
+		wrappedFile.close ()
+		savFile.close ()
+		savData = savbinary.SAVDataset (self.path ("wrapped.sav.gz"))
+		try:
+			firstPass = list (savData.getCaseStream ())
+			self.assertEqual (len (firstPass), 50)
+			self.assertEqual (list (savData.getCaseStream ()), firstPass)
+			self.assertEqual (savData.spoolFile, None)
+		finally:
+			savData.close ()
+		savschema.convertSAVFile (self.path ("wrapped.sav"), getOptions ())
+		plainData = self.read ("wrapped.asc")
+		savschema.convertSAVFile (self.path ("wrapped.sav.gz"), getOptions ())
+		self.assertEqual (self.read ("wrapped.asc"), plainData)
+
+	def testSampleSizingWithUnconvertibleDate (self):
+		ages = [float (case % 90) for case in xrange (400)]
+		ages [300] = 123456.0
+		writeSAVFile (self.path ("sample.sav"), [
+			("DOB", 20, 11, "Date of birth", dates (400, 5)),
+			("AGE", 5, 3, "Age", ages)])
+		savschema.convertSAVFile (self.path ("sample.sav"), getOptions ())
+		fullData = self.read ("sample.asc")
+		self.assertEqual (savschema.convertSAVFile (self.path ("sample.sav"),
+			getOptions (sampleSize=20)), 400)
+		self.assertEqual (self.read ("sample.asc"), fullData)
+
+class BatchTest (unittest.TestCase):
+
+	def testOutputClashes (self):
+		clashes = savschema.findOutputClashes (["t.sav", "t.zsav", "t.sav.gz", "u.sav", "v.sav.bz2"])
+		self.assertEqual (sorted (clashes), ["t.sav", "t.sav.gz", "t.zsav"])
+		self.assert_ ("t.xml" in clashes ["t.zsav"])
+
+class CaseSelectionTest (unittest.TestCase):
+
+	def testInvalidSelections (self):
+		for limit, every, fraction in ((0, None, None), (-5, None, None), (None, 0, None),
+			(None, -2, None), (None, None, 0.0), (None, None, -0.5), (None, None, 1.5)):
+			self.assertRaises (savschema.SavSchemaError, savschema.getCaseSelection,
+				limit, every, fraction)
+
+	def testValidSelections (self):
+		self.assertEqual (savschema.getCaseSelection (None, None, None), None)
+		self.assertEqual (savschema.getCaseSelection (10, 1, 1.0).getKey (), (10, 1, 1.0, 0))
+
+class CaseSelectionStreamTest (unittest.TestCase):
+
+	def setUp (self):
+		self.directory = tempfile.mkdtemp ()
+
+	def tearDown (self):
+		shutil.rmtree (self.directory)
+
+	def getCaseNumbers (self, compressed, start, stop, spool=False):
+		filename = os.path.join (self.directory, "cases.sav")
+		writeSAVFile (filename, [("CASE", 5, 8, "Case", [float (case) for case in xrange (1000)])],
+			compressed=compressed)
+		savData = savbinary.SAVDataset (filename, spool=spool,
+			caseSelection=savbinary.CaseSelection (every=7))
+		try:
+			if spool:
+				list (savData.getCaseStream ())
+				self.assertNotEqual (savData.spoolFile, None)
+			return [int (case [0] [1]) for case in savData.getCaseStream ("ignore", start, stop)]
+		finally:
+			savData.close ()
+
+	def testStreamsBoundedByCaseNumber (self):
+		expected = range (301, 600, 7)
+		self.assertEqual (self.getCaseNumbers (False, 300, 600), expected)
+		self.assertEqual (self.getCaseNumbers (True, 300, 600), expected)
+		self.assertEqual (self.getCaseNumbers (True, 300, 600, spool=True), expected)
+		self.assertEqual (self.getCaseNumbers (True, 0, 50, spool=True), range (0, 50, 7))
+
+class TextCacheTest (unittest.TestCase):
+
+	def testEvenlyUsedValues (self):
+		textCache = savbinary.TextCache ()
+		for case in xrange (5000):
+			self.assertEqual (textCache.lookup ("%8d" % (case % 500), unicode), u"%8d" % (case % 500))
+		self.assert_ (textCache.enabled)
+		self.assertEqual ((textCache.lookups, textCache.misses), (5000, 500))
+
+	def testDistinctValues (self):
+		textCache = savbinary.TextCache (size=100)
+		for case in xrange (150):
+			self.assertEqual (textCache.lookup ("%8d" % case, unicode), u"%8d" % case)
+		self.failIf (textCache.enabled)
+
+	def testConversionArguments (self):
+		textCache = savbinary.TextCache ()
+		self.assertEqual (textCache.lookup ("abc  ", lambda value, strip: value.strip (strip), " "), "abc")
+		self.assertEqual (textCache.lookup ("abc  ", None), "abc")
+
+if __name__ == "__main__":
+	unittest.main ()